@@ -0,0 +1,385 @@
+# coding: utf-8
+"""
+Measures graph_migrator throughput against a synthetic Arches v3 export.
+
+The export is generated from the real graphdiffs in resources/graphdiffs,
+along with a matching .mapping zip for every resource model, and then each
+stage of the migration is timed in its own process: load, flatten, field
+name conversion, datatype fixing, row condensation and CSV write.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from resource import getrusage, RUSAGE_SELF
+from zipfile import ZipFile
+
+from graph_migrator import Migration, Resource, iter_v3_resources
+
+STAGES = ['load', 'flatten', 'fieldnames', 'datatypes', 'condense', 'write']
+
+# the v4 datatype of a node, going by the CIDOC class of the v3 entity type
+DATATYPES = {
+    'E47': 'geojson-feature-collection',
+    'E49': 'date',
+    'E55': 'concept',
+    'E60': 'number',
+}
+
+BUSINESSTABLES = {
+    'string': 'strings',
+    'number': 'numbers',
+    'date': 'dates',
+    'geojson-feature-collection': 'geometries',
+    'concept': 'domains',
+}
+
+# entity types that only group other entities and hold no data in v3
+SEMANTIC_CLASSES = set(['E3', 'E5', 'E7', 'E11', 'E12', 'E13', 'E14', 'E17',
+                        'E18', 'E27', 'E39', 'E52', 'E53', 'E63', 'E64',
+                        'E65', 'E73'])
+
+PRIMARY_NAME_TYPE = "a4c88313-52c5-4b6a-9579-3fc5aad17335"
+
+WORDS = [u'stone', u'house', u'mill', u'church', u'bridge', u'farm', u'north',
+         u'old', u'brick', u'timber', u'café', u'römer', u'road', u'garden']
+
+
+class SyntheticExport:
+    """Writes a v3 business data export and the v4 mappings to go with it
+    into a directory.
+    """
+
+    def __init__(self, directory, config=".migrator_config.json", seed=0):
+        self._dir = directory
+        self._random = random.Random(seed)
+        self._models = {}
+        self._nodes = 0
+
+        with open(config, 'r') as config:
+            self._config = json.load(config)
+
+    @property
+    def v3_file(self):
+        return os.path.join(self._dir, 'v3_business_data.json')
+
+    @property
+    def mappings_dir(self):
+        return os.path.join(self._dir, 'mappings')
+
+    @property
+    def nodes(self):
+        "the number of data nodes the export flattens to"
+        return self._nodes
+
+    def uuid(self):
+        return str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+
+    def write_mappings(self):
+        if not os.path.exists(self.mappings_dir):
+            os.makedirs(self.mappings_dir)
+
+        graphdiff_path = self._config['graphdiff_path']
+
+        for v3_name, filename in self._config['graphdiffs'].items():
+            v4_name = self._config['namediffs'][v3_name]
+            with open(graphdiff_path + filename, 'r') as gdiff:
+                graphdiff = json.load(gdiff)
+
+            datatypes = {}
+            concepts = {}
+            for entitytypeid, node_name in sorted(graphdiff.items()):
+                datatype = DATATYPES.get(entitytypeid.split('.')[-1],
+                                         'string')
+                datatypes.setdefault(node_name, datatype)
+                if datatypes[node_name] == 'concept':
+                    concepts.setdefault(node_name, dict(
+                        (self.uuid(), u'{0} {1}'.format(node_name, i))
+                        for i in range(10)))
+
+            mapping = {
+                'resource_model_id': self.uuid(),
+                'resource_model_name': v4_name,
+                'nodes': [{'arches_nodeid': self.uuid(),
+                           'arches_node_name': node_name,
+                           'data_type': node_datatype,
+                           'export': False,
+                           'file_field_name': node_name}
+                          for node_name, node_datatype in
+                          sorted(datatypes.items())]
+            }
+
+            with ZipFile(os.path.join(self.mappings_dir,
+                                      v4_name + '.zip'), 'w') as mzip:
+                mzip.writestr(v4_name + '.mapping', json.dumps(mapping))
+                mzip.writestr(v4_name + '_concepts.json',
+                              json.dumps(concepts))
+
+            self._models[v3_name] = (sorted(graphdiff), datatypes,
+                                     graphdiff, concepts)
+
+    def value(self, datatype, node_name, concepts):
+        rand = self._random
+        if datatype == 'date':
+            return '{0:04d}-{1:02d}-{2:02d}T00:00:00'.format(
+                rand.randint(1700, 2017), rand.randint(1, 12),
+                rand.randint(1, 28))
+        if datatype == 'number':
+            return '{0:,}'.format(rand.randint(0, 100000))
+        if datatype == 'concept':
+            return rand.choice(sorted(concepts[node_name]))
+        if datatype == 'geojson-feature-collection':
+            x, y = rand.uniform(-180, 180), rand.uniform(-85, 85)
+            return 'POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {1}))'.format(
+                x, y, x + 0.001, y + 0.001)
+        return u' '.join(rand.choice(WORDS)
+                         for i in range(rand.randint(1, 12)))
+
+    def entity(self, v3_name, entitytypeid, depth, breadth):
+        entitytypes, datatypes, graphdiff, concepts = self._models[v3_name]
+        node_name = graphdiff[entitytypeid]
+        datatype = datatypes[node_name]
+
+        children = []
+        if depth > 1:
+            for i in range(self._random.randint(0, breadth)):
+                children.append(self.entity(
+                    v3_name, self._random.choice(entitytypes),
+                    depth - 1, breadth))
+
+        if entitytypeid.split('.')[-1] in SEMANTIC_CLASSES:
+            businesstablename, value = "", ""
+        else:
+            businesstablename = BUSINESSTABLES[datatype]
+            if entitytypeid == 'NAME_TYPE.E55' and \
+               self._random.random() < 0.5:
+                value = PRIMARY_NAME_TYPE
+            else:
+                value = self.value(datatype, node_name, concepts)
+            self._nodes += 1
+
+        return {
+            'businesstablename': businesstablename,
+            'child_entities': children,
+            'entityid': self.uuid(),
+            'entitytypeid': entitytypeid,
+            'label': value,
+            'property': '',
+            'value': value,
+        }
+
+    def resource(self, v3_name, depth, breadth):
+        entitytypes = self._models[v3_name][0]
+        return {
+            'businesstablename': "",
+            'child_entities': [
+                self.entity(v3_name, self._random.choice(entitytypes),
+                            depth, breadth)
+                for i in range(breadth)],
+            'entityid': self.uuid(),
+            'entitytypeid': v3_name,
+            'label': '',
+            'property': '',
+            'value': '',
+        }
+
+    def write(self, count, depth=3, breadth=4, models=None):
+        """Write `count` resources spread evenly over the given v3 resource
+        models, each with `breadth` top level entities nested `depth`
+        deep.
+        """
+        self.write_mappings()
+        models = sorted(models or self._models)
+
+        with open(self.v3_file, 'w') as v3_file:
+            v3_file.write('{"resources": [\n')
+            for i in range(count):
+                if i > 0:
+                    v3_file.write(',\n')
+                v3_name = models[i % len(models)]
+                json.dump(self.resource(v3_name, depth, breadth), v3_file)
+            v3_file.write('\n]}\n')
+
+
+def peak_rss():
+    "peak resident set size of this process in MB"
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_stages(v3_file, mappings_dir, output_dir, last):
+    """Run the migration up to and including the stage `last`, timing each
+    stage on its own. Setup, like building a model's field name table,
+    isn't counted.
+    """
+    # field name tables are shared between stages so they're only built
+    # once per benchmark
+    migration = Migration(v3_file, mappings_dir, output_dir, ["<all>"],
+                          fieldname_tables=os.path.join(output_dir,
+                                                        'fieldnames'))
+    migrators = {}
+    writers = {}
+    timings = dict((stage, 0.0) for stage in STAGES)
+    stop = STAGES.index(last)
+    count = 0
+
+    reader = iter_v3_resources(v3_file)
+    while True:
+        start = time.time()
+        try:
+            data = next(reader)
+        except StopIteration:
+            break
+        timings['load'] += time.time() - start
+        count += 1
+
+        if stop < STAGES.index('flatten'):
+            continue
+
+        name = data['entitytypeid']
+        migrator = migrators.get(name)
+        if migrator is None:
+            migrator = migration.build_migrator(name)
+            table_path = migration.fieldname_table_path(migrator.converter)
+            if not os.path.exists(table_path):
+                migrator.converter.save_fieldname_table(table_path)
+            migrators[name] = migrator
+        converter = migrator.converter
+
+        start = time.time()
+        resource = Resource(data)
+        timings['flatten'] += time.time() - start
+
+        if stop < STAGES.index('fieldnames'):
+            continue
+
+        start = time.time()
+        v4_names = [converter.convert_v3_fieldname(node[0])
+                    for node in resource.nodes]
+        timings['fieldnames'] += time.time() - start
+
+        if stop < STAGES.index('datatypes'):
+            continue
+
+        start = time.time()
+        v4_nodes = [(v4_name, migrator.fixer.fix_datatype(
+            converter.get_datatype(v4_name), node[1], v4_name))
+            for v4_name, node in zip(v4_names, resource.nodes)]
+        timings['datatypes'] += time.time() - start
+
+        if stop < STAGES.index('condense'):
+            continue
+
+        start = time.time()
+        rows = migrator.get_v4_rows(v4_nodes, resource.resource_id)
+        timings['condense'] += time.time() - start
+
+        if stop < STAGES.index('write'):
+            continue
+
+        writer = writers.get(name)
+        if writer is None:
+            writer = migration.open_writer(migrator)
+            writers[name] = writer
+
+        start = time.time()
+        writer.writerows(rows)
+        timings['write'] += time.time() - start
+
+    start = time.time()
+    for writer in writers.values():
+        writer.close()
+    timings['write'] += time.time() - start
+
+    return timings[last], count, peak_rss()
+
+
+def benchmark(export, output_dir):
+    results = []
+    for stage in STAGES:
+        # a fresh process per stage so that peak RSS is the peak of the
+        # pipeline up to that stage
+        pool = multiprocessing.Pool(1)
+        try:
+            seconds, count, rss = pool.apply(
+                run_stages,
+                (export.v3_file, export.mappings_dir, output_dir, stage))
+        finally:
+            pool.close()
+            pool.join()
+
+        results.append({
+            'stage': stage,
+            'seconds': seconds,
+            'resources': count,
+            'nodes': export.nodes,
+            'resources_per_sec': count / seconds if seconds else None,
+            'nodes_per_sec': export.nodes / seconds if seconds else None,
+            'peak_rss_mb': rss,
+        })
+    return results
+
+
+def format_results(results):
+    lines = ['{0:<12}{1:>10}{2:>16}{3:>16}{4:>14}'.format(
+        'stage', 'seconds', 'resources/sec', 'nodes/sec', 'peak RSS MB')]
+    for result in results:
+        lines.append('{0:<12}{1:>10.3f}{2:>16.0f}{3:>16.0f}{4:>14.1f}'.format(
+            result['stage'], result['seconds'],
+            result['resources_per_sec'] or 0, result['nodes_per_sec'] or 0,
+            result['peak_rss_mb']))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-n", "--resources", type=int, default=10000,
+                        help="The number of resources to generate")
+    parser.add_argument("-d", "--depth", type=int, default=3,
+                        help="How deep to nest each resource's entities")
+    parser.add_argument("-b", "--breadth", type=int, default=4,
+                        help="The most child entities an entity can have")
+    parser.add_argument("--process-model", nargs="+",
+                        help="Only generate resources for these v3 resource "
+                        "models")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep",
+                        help="A directory to keep the generated export, "
+                        "mappings and CSVs in")
+    parser.add_argument("--json",
+                        help="Also write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='graph_migrator_bench')
+    output_dir = os.path.join(workdir, 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    try:
+        export = SyntheticExport(workdir, seed=args.seed)
+        export.write(args.resources, args.depth, args.breadth,
+                     args.process_model)
+
+        results = benchmark(export, output_dir)
+        print(format_results(results))
+
+        if args.json:
+            with open(args.json, 'w') as outfile:
+                json.dump({'resources': args.resources,
+                           'depth': args.depth,
+                           'breadth': args.breadth,
+                           'seed': args.seed,
+                           'stages': results},
+                          outfile, indent=4, sort_keys=True)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(workdir)
@@ -2,17 +2,525 @@
 import unicodecsv as csv
 import json
 import argparse
+import codecs
+import cStringIO
+import csv as stdcsv
+import cProfile
+import glob
+import gzip
+import hashlib
+import itertools
 import os
+import Queue
+import re
 import logging
-
-from zipfile import ZipFile
+import marshal
+import mmap
+import multiprocessing
+import operator
+import shutil
+import threading
+import time
+import traceback
+
+from array import array
+from zipfile import BadZipfile, ZipFile
 from fuzzywuzzy import process
 from string import capwords
-from datetime import datetime
+from datetime import date, datetime
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process, \
+        utils as rapid_utils
+except ImportError:
+    rapid_process = None
+
+# replaced by get_logger when run from the command line
+logger = logging.getLogger()
+
+
+# YYYY-MM-DD, optionally followed by a time and UTC offset, which covers
+# nearly every date in a v3 export
+_ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                       r'(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?'
+                       r'(?:Z|[+-]\d{2}:?\d{2})?$')
+
+# other shapes of date, tried in order when the fast path doesn't match.
+# dd/mm/yyyy and mm/dd/yyyy can't be told apart, so neither is guessed at;
+# those dates are left as they are and listed with the other unparsed ones
+DATE_FORMATS = [
+    '%Y/%m/%d',
+    '%Y%m%d',
+    '%d %B %Y',
+    '%d %b %Y',
+    '%B %d, %Y',
+    '%b %d, %Y',
+]
+
+
+def parse_date(value):
+    """Return a v3 date value as YYYY-MM-DD, or None if it isn't in a form
+    we recognize.
+    """
+    value = value.strip()
+    match = _ISO_DATE.match(value)
+    if match is not None:
+        try:
+            return date(*[int(part) for part in match.groups()]).isoformat()
+        except ValueError:
+            return None
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+
+    return None
+
+
+CONCEPT_DATATYPES = frozenset(['concept', 'concept-list',
+                               'domain-value', 'domain-value-list'])
+
+
+def quote_label(label):
+    """A prefLabel containing a comma has to be wrapped in double quotes,
+    which the CSV writer then escapes.
+    """
+    if u',' in label:
+        return u'"' + label + u'"'
+    return label
+
+
+# a WKT token: a geometry keyword, a bracket or comma, or all the ordinates
+# of one point
+_WKT_TOKEN = re.compile(r'[A-Za-z]+|[(),]|[-+.\d][-+.\deE]*'
+                        r'(?:\s+[-+.\d][-+.\deE]*)*')
+_WKT_JUNK = re.compile(r'[^\sA-Za-z\d().,+-]')
+
+# a polygon with a single ring, which is what most parcels are
+_WKT_POLYGON = re.compile(r'\s*POLYGON\s*\(\s*\(([^()]*)\)\s*\)\s*$', re.I)
+
+WKT_KINDS = frozenset(['POINT', 'LINESTRING', 'POLYGON', 'MULTIPOINT',
+                       'MULTILINESTRING', 'MULTIPOLYGON',
+                       'GEOMETRYCOLLECTION'])
+
+
+class WKTNormalizer:
+    """Cleans up v3 WKT the way Elasticsearch needs it in v4: polygon rings
+    are closed and wound the right way round (exterior rings
+    counterclockwise, holes clockwise), repeated consecutive vertices are
+    dropped and, given a precision, coordinates are rounded to that many
+    decimal places. Geometry that needs none of that is passed through
+    exactly as it was.
+
+    Geometry that can't be parsed, or that has too few vertices left once
+    the duplicates are gone, is passed through as well and counted in
+    `invalid`, which keeps a sample of it for the log. Exports repeat
+    geometries, so results are cached, and a polygon with a single ring
+    skips the tokenizer altogether.
+    """
+
+    CACHE_SIZE = 10000
+    # how many different invalid geometries are kept for the log, and how
+    # much of each
+    SAMPLE_SIZE = 20
+    SAMPLE_LENGTH = 200
+
+    def __init__(self, precision=None):
+        self._precision = precision
+        self._cache = {}
+        self._invalid = {'count': 0, 'sample': {}}
+
+    @property
+    def precision(self):
+        return self._precision
+
+    @property
+    def invalid(self):
+        """how many geometries couldn't be normalized, and a sample of the
+        first SAMPLE_SIZE different ones, cut to SAMPLE_LENGTH characters,
+        with how often each was seen
+        """
+        return self._invalid
+
+    def add_invalid(self, invalid):
+        "add counts in the form of `invalid`, keeping to the sample size"
+        add_sample(self._invalid, invalid, self.SAMPLE_SIZE)
+
+    def normalize(self, wkt):
+        try:
+            fixed = self._cache[wkt]
+        except KeyError:
+            try:
+                fixed = self.fix(wkt)
+            except (ValueError, IndexError):
+                fixed = None
+
+            # invalid geometry is cached as None, so it isn't parsed again
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            self._cache[wkt] = fixed
+
+        if fixed is None:
+            self.add_invalid(sample_of(wkt, self.SAMPLE_LENGTH))
+            return wkt
+        return fixed
+
+    def fix_flat_ring(self, text):
+        """The fast path for a 2D polygon with a single ring, working on
+        flat lists of ordinates rather than points: (whether anything had
+        to change, the ring's text), or None to leave it to the general
+        path.
+        """
+        flat = text.replace(u',', u' ').split()
+        if len(flat) != 2 * (text.count(u',') + 1):
+            return None
+        try:
+            values = map(float, flat)
+        except ValueError:
+            return None
+
+        changed = False
+        if self._precision is not None:
+            rounded = map(round, values, [self._precision] * len(values))
+            changed = rounded != values
+            values = rounded
+
+        points = zip(values[0::2], values[1::2])
+        texts = zip(flat[0::2], flat[1::2])
+
+        if any(map(operator.eq, points[:-1], points[1:])):
+            keep = [0] + [i for i in range(1, len(points))
+                          if points[i] != points[i - 1]]
+            points = [points[i] for i in keep]
+            texts = [texts[i] for i in keep]
+            changed = True
+
+        if points[0] != points[-1]:
+            points.append(points[0])
+            texts.append(texts[0])
+            changed = True
+
+        if len(points) < 4:
+            return None
+
+        if self.winding(points) < 0:
+            points.reverse()
+            texts.reverse()
+            changed = True
+
+        if not changed:
+            return False, text
+        if self._precision is not None:
+            texts = [(self.format_ordinate(x), self.format_ordinate(y))
+                     for x, y in points]
+        return True, u', '.join(u' '.join(point) for point in texts)
+
+    def fix(self, wkt):
+        match = _WKT_POLYGON.match(wkt)
+        if match is not None:
+            fixed = self.fix_flat_ring(match.group(1))
+            if fixed is not None:
+                changed, ring = fixed
+                return u'POLYGON ((' + ring + u'))' if changed else wkt
+
+        if _WKT_JUNK.search(wkt):
+            raise ValueError("not WKT: {0!r}".format(wkt[:80]))
+        tokens = _WKT_TOKEN.findall(wkt)
+        geometry, pos = self.parse_geometry(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError("more after the geometry")
+
+        geometry, changed = self.fix_geometry(geometry)
+        if not changed:
+            return wkt
+        return self.format_geometry(geometry)
+
+    def parse_point(self, text):
+        """(ordinates as text, ordinates, whether rounding moved it), with
+        the text rewritten to the precision if there is one
+        """
+        texts = text.split()
+        if not 2 <= len(texts) <= 4:
+            raise ValueError("not a point: {0!r}".format(text))
+        values = tuple(float(value) for value in texts)
+
+        if self._precision is None:
+            return texts, values, False
+
+        rounded = tuple(round(value, self._precision) for value in values)
+        return ([self.format_ordinate(value) for value in rounded],
+                rounded, rounded != values)
+
+    def format_ordinate(self, value):
+        text = '%.*f' % (self._precision, value)
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if text == '-0':
+            text = '0'
+        return text
+
+    def parse_geometry(self, tokens, pos):
+        "((kind, dimensions, coordinates), position after it)"
+        kind = tokens[pos].upper()
+        if kind not in WKT_KINDS:
+            raise ValueError("not a geometry: {0!r}".format(kind))
+        pos += 1
+
+        dimensions = u''
+        if tokens[pos].upper() in ('Z', 'M', 'ZM'):
+            dimensions = tokens[pos].upper()
+            pos += 1
+
+        if tokens[pos].upper() == 'EMPTY':
+            return (kind, dimensions, None), pos + 1
+
+        if kind != 'GEOMETRYCOLLECTION':
+            coordinates, pos = self.parse_coordinates(tokens, pos)
+            return (kind, dimensions, coordinates), pos
+
+        if tokens[pos] != '(':
+            raise ValueError("expected (")
+        members = []
+        while True:
+            member, pos = self.parse_geometry(tokens, pos + 1)
+            members.append(member)
+            if tokens[pos] == ')':
+                return (kind, dimensions, members), pos + 1
+            if tokens[pos] != ',':
+                raise ValueError("expected , or )")
+
+    def parse_coordinates(self, tokens, pos):
+        "bracketed lists of points, nested as deep as they go"
+        if tokens[pos] != '(':
+            return self.parse_point(tokens[pos]), pos + 1
+
+        items = []
+        while True:
+            item, pos = self.parse_coordinates(tokens, pos + 1)
+            items.append(item)
+            if tokens[pos] == ')':
+                return items, pos + 1
+            if tokens[pos] != ',':
+                raise ValueError("expected , or )")
+
+    def points(self, items):
+        "items that should be a list of points, and whether rounding moved any"
+        if not isinstance(items, list) or \
+           not all(isinstance(point, tuple) for point in items):
+            raise ValueError("expected a list of points")
+        return items, any(point[2] for point in items)
+
+    def fix_line(self, items, least=2):
+        points, changed = self.points(items)
+
+        deduped = points[:1]
+        for point in points[1:]:
+            if point[1] != deduped[-1][1]:
+                deduped.append(point)
+        if len(deduped) < least:
+            raise ValueError("too few distinct points")
+
+        return deduped, changed or len(deduped) != len(points)
+
+    def fix_ring(self, items, exterior):
+        ring, changed = self.fix_line(items, 3)
+
+        if ring[0][1] != ring[-1][1]:
+            ring.append(ring[0])
+            changed = True
+        if len(ring) < 4:
+            raise ValueError("too few distinct points in a ring")
+
+        area = self.winding([point[1] for point in ring])
+        if (area < 0 if exterior else area > 0):
+            ring.reverse()
+            changed = True
+
+        return ring, changed
+
+    def winding(self, points):
+        """twice a closed ring's signed area, positive when it runs
+        counterclockwise
+        """
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        return sum(map(operator.mul, xs[:-1], ys[1:])) - \
+            sum(map(operator.mul, xs[1:], ys[:-1]))
+
+    def fix_polygon(self, rings):
+        if not isinstance(rings, list) or not rings:
+            raise ValueError("expected a list of rings")
+
+        fixed, changed = [], False
+        for index, ring in enumerate(rings):
+            ring, ring_changed = self.fix_ring(ring, index == 0)
+            fixed.append(ring)
+            changed = changed or ring_changed
+        return fixed, changed
+
+    def fix_each(self, fix, items):
+        if not isinstance(items, list) or not items:
+            raise ValueError("expected a list")
+
+        fixed, changed = [], False
+        for item in items:
+            item, item_changed = fix(item)
+            fixed.append(item)
+            changed = changed or item_changed
+        return fixed, changed
+
+    def fix_geometry(self, geometry):
+        "(geometry, whether anything about it had to change)"
+        kind, dimensions, coordinates = geometry
+        if coordinates is None:
+            return geometry, False
+
+        if kind == 'POINT':
+            coordinates, changed = self.points(coordinates)
+            if len(coordinates) != 1:
+                raise ValueError("expected one point")
+        elif kind == 'LINESTRING':
+            coordinates, changed = self.fix_line(coordinates)
+        elif kind == 'POLYGON':
+            coordinates, changed = self.fix_polygon(coordinates)
+        elif kind == 'MULTIPOINT':
+            # both (1 2, 3 4) and ((1 2), (3 4)) turn up
+            coordinates, changed = self.fix_each(
+                lambda point: self.points(
+                    [point] if isinstance(point, tuple) else point),
+                coordinates)
+        elif kind == 'MULTILINESTRING':
+            coordinates, changed = self.fix_each(self.fix_line, coordinates)
+        elif kind == 'MULTIPOLYGON':
+            coordinates, changed = self.fix_each(self.fix_polygon,
+                                                 coordinates)
+        else:
+            coordinates, changed = self.fix_each(self.fix_geometry,
+                                                 coordinates)
+
+        return (kind, dimensions, coordinates), changed
+
+    def format_coordinates(self, coordinates):
+        if isinstance(coordinates, tuple):
+            return u' '.join(coordinates[0])
+        return u'(' + u', '.join(self.format_coordinates(item)
+                                 for item in coordinates) + u')'
+
+    def format_geometry(self, geometry):
+        kind, dimensions, coordinates = geometry
+        head = kind + (u' ' + dimensions if dimensions else u'')
+
+        if coordinates is None:
+            return head + u' EMPTY'
+        if kind == 'GEOMETRYCOLLECTION':
+            return head + u' (' + u', '.join(
+                self.format_geometry(member)
+                for member in coordinates) + u')'
+        return head + u' ' + self.format_coordinates(coordinates)
+
+
+class ConceptResolver:
+    """Resolves the values of concept and domain-value nodes to UUIDs from
+    the mapping's concept collections. Each collection gets a hashed index
+    of its UUIDs and prefLabels the first time one of its nodes is seen.
+
+    Values that are already one of the collection's UUIDs pass straight
+    through and unique prefLabels become their UUID. Anything else is
+    passed through as it is and recorded in `unresolved` (unknown values)
+    or `ambiguous` (prefLabels shared by several concepts), keyed by node
+    and value with a count.
+    """
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+        self._indexes = {}
+        self._unresolved = {}
+        self._ambiguous = {}
+
+    @property
+    def unresolved(self):
+        return self._unresolved
+
+    @property
+    def ambiguous(self):
+        return self._ambiguous
+
+    def index(self, node_name):
+        index = self._indexes.get(node_name)
+        if index is None:
+            collection = self._mapping.collection(node_name)
+            labels = {}
+            duplicates = set()
+            for uuid, label in collection.items():
+                if label in labels:
+                    duplicates.add(label)
+                labels[label] = uuid
+            for label in duplicates:
+                del labels[label]
+
+            index = (frozenset(collection), labels, duplicates)
+            self._indexes[node_name] = index
+        return index
+
+    def resolve(self, node_name, value):
+        uuids, labels, duplicates = self.index(node_name)
+
+        if value in uuids:
+            return value
+
+        uuid = labels.get(value)
+        if uuid is not None:
+            return uuid
+
+        if value in duplicates:
+            add_counts(self._ambiguous, {node_name: {value: 1}})
+        else:
+            add_counts(self._unresolved, {node_name: {value: 1}})
+        return value
+
+
+def add_counts(counts, more):
+    "add nested {key: ... {key: count}} counts in `more` to `counts`"
+    for key, value in more.items():
+        if isinstance(value, dict):
+            add_counts(counts.setdefault(key, {}), value)
+        else:
+            counts[key] = counts.get(key, 0) + value
+
+
+def sample_of(value, length):
+    "a {count, sample} record of one value, cut to `length` characters"
+    return {'count': 1, 'sample': {value[:length]: 1}}
+
+
+def add_sample(record, more, size):
+    """add the {count, sample} record `more` to `record`, where sample maps
+    values to how often each was seen. Every value is counted, but only
+    the first `size` different ones are kept in the sample, so the record
+    stays small enough to send back from workers and save in checkpoints.
+    """
+    record['count'] += more['count']
+    sample = record['sample']
+    for value, n in more['sample'].items():
+        if value in sample or len(sample) < size:
+            sample[value] = sample.get(value, 0) + n
 
 
 class DTFixer:
-    def __init__(self):
+    DATE_CACHE_SIZE = 10000
+    # how many different unparsed dates are kept for the log, and how much
+    # of each
+    DATE_SAMPLE_SIZE = 20
+    DATE_SAMPLE_LENGTH = 200
+
+    def __init__(self, resolver=None, wkt_precision=None):
+        self._resolver = resolver
+        self._dates = {}
+        self._unparsed_dates = {'count': 0, 'sample': {}}
+        self._wkt = WKTNormalizer(wkt_precision)
+
         def fix_string(data):
             """string - Strings need not be single-quoted unless they contain a
             comma or contain HTML tags (as in the case strings
@@ -33,12 +541,28 @@ class DTFixer:
             not four digits must be zero padded (01-02-1999). No
             quotes.
             """
-            # This is brittle, developed for one specific installation
+            # Exports repeat the same dates heavily, so parsed values are
+            # remembered, up to DATE_CACHE_SIZE of them, and values we
+            # can't parse are remembered as None.
+            # Those are passed through as they are and counted in
+            # unparsed_dates rather than stopping the run.
 
             if data == '':
                 return data
-            return datetime.strptime(data,
-                                     "%Y-%m-%dT%H:%M:%S").date().isoformat()
+
+            try:
+                fixed = self._dates[data]
+            except KeyError:
+                fixed = parse_date(data)
+                if len(self._dates) >= self.DATE_CACHE_SIZE:
+                    self._dates.clear()
+                self._dates[data] = fixed
+
+            if fixed is None:
+                self.add_unparsed_dates(sample_of(data,
+                                                  self.DATE_SAMPLE_LENGTH))
+                return data
+            return fixed
 
         def fix_geojson(data):
             """geojson-feature-collection - All geometry must be formatted in
@@ -46,10 +570,13 @@ class DTFixer:
             84 (EPSG:4326) decimal degrees. Multi geometries must be
             single-quoted.
             """
-            # All the WKT looks valid other than the same error we
-            # encounter with Elasticsearch's pedantry elsewhere; when
-            # we figure out how to fix that, the logic will go here.
-            return data
+            # The WKT from v3 is valid, but Elasticsearch is pickier:
+            # unclosed or wrongly wound rings and repeated vertices stop
+            # it indexing. The CSV writer already quotes any value with a
+            # comma in it, which covers the multi geometries.
+            if data == '':
+                return data
+            return self._wkt.normalize(data)
 
         def fix_concept(data):
             """concept - If the values in your concept collection are
@@ -60,8 +587,9 @@ class DTFixer:
             triple-quoted:
             """
             # V3 JSON holds the Preflabel in "Label" and the UUID in
-            # "Value" which we pass anyway, so no action is necessary
-            return data
+            # "Value" which we pass anyway; fix_datatype has already
+            # swapped any label it could resolve for its UUID
+            return quote_label(data)
 
         def fix_list(data):
             """
@@ -70,8 +598,9 @@ class DTFixer:
             prefLabel contains a comma, then that prefLabel must have
             double-quotes: "Slate,""Shingles, original"",Thatch".
             """
+            # each v3 value is a single item of the list
 
-            return data
+            return quote_label(data)
 
         def fix_filepath(data):
             """
@@ -92,7 +621,36 @@ class DTFixer:
             'file-list': fix_filepath
         }
 
-    def fix_datatype(self, datatype, data):
+    @property
+    def datatypes(self):
+        "the v4 datatypes there's a fixer for"
+        return set(self._fixers)
+
+    @property
+    def unparsed_dates(self):
+        """how many date values couldn't be parsed, and a sample of the
+        first DATE_SAMPLE_SIZE different ones, cut to DATE_SAMPLE_LENGTH
+        characters, with how often each was seen
+        """
+        return self._unparsed_dates
+
+    @property
+    def resolver(self):
+        return self._resolver
+
+    @property
+    def wkt(self):
+        return self._wkt
+
+    def add_unparsed_dates(self, unparsed):
+        "add counts in the form of `unparsed_dates`, keeping to the sample size"
+        add_sample(self._unparsed_dates, unparsed, self.DATE_SAMPLE_SIZE)
+
+    def fix_datatype(self, datatype, data, node_name=None):
+
+        if self._resolver is not None and datatype in CONCEPT_DATATYPES \
+           and data != '':
+            data = self._resolver.resolve(node_name, data)
 
         return self._fixers[datatype](data)
 
@@ -114,35 +672,118 @@ class GraphDiff:
 
 
 class Mapping:
-    def __init__(self, path):
-        self._node_datatypes = {}
-        self._preflabel_uuids = {}
+    # bump when the layout of the cache files changes
+    CACHE_VERSION = 2
+
+    def __init__(self, path, cache_dir=None):
+        self._path = path
+        self._cache_dir = cache_dir
+        self._zip_hash = None
+        self._collections = None
 #        self._logger = logging.getLogger('graph_migrator')
         self._dir, self._filename = os.path.split(path)
-        with ZipFile(path) as mzip:
+
+        mapping = self.load_cached('mapping', self.read_mapping)
+        self._data = mapping['data']
+        self._resource_name = self._data['resource_model_name']
+        self._node_datatypes = mapping['node_datatypes']
+
+        self._fieldnames = [node['arches_node_name'] for node in
+                            self.data['nodes']]
+
+    def read_mapping(self):
+        with ZipFile(self._path) as mzip:
             mapping = json.load(
                 mzip.open(self._filename.replace('.zip',
                                                  '.mapping')))
-            self._data = mapping
-            self._resource_name = mapping['resource_model_name']
 
-            self._node_datatypes = {node['arches_node_name']:
-                                    node['data_type'] for node in
-                                    mapping['nodes']}
+        node_datatypes = {node['arches_node_name']:
+                          node['data_type'] for node in
+                          mapping['nodes']}
+
+        return {'data': mapping, 'node_datatypes': node_datatypes}
+
+    def read_concepts(self):
+        collections = {}
+
+        with ZipFile(self._path) as mzip:
             concepts = json.load(
                 mzip.open(self._filename.replace('.zip',
                                                  '_concepts.json')))
 
-            for ctype in concepts.items():
-                if str(type(ctype[1])) == "<type 'unicode'>":
-                    # self._logger.debug(ctype[1])
-                    pass
-                else:
-                    for concept in ctype[1].items():
-                        self._preflabel_uuids[concept[1]] = concept[0]
+        for ctype in concepts.items():
+            if str(type(ctype[1])) == "<type 'unicode'>":
+                # a note like "Collection is empty" rather than concepts
+                # self._logger.debug(ctype[1])
+                pass
+            else:
+                collections[ctype[0]] = ctype[1]
 
-        self._fieldnames = [node['arches_node_name'] for node in
-                            self.data['nodes']]
+        return collections
+
+    @property
+    def collections(self):
+        """node name -> {UUID: prefLabel} for each concept collection, read
+        from the zip the first time it's needed"""
+        if self._collections is None:
+            self._collections = self.load_cached('concepts',
+                                                 self.read_concepts)
+        return self._collections
+
+    def collection(self, node_name):
+        return self.collections.get(node_name, {})
+
+    def zip_hash(self):
+        if self._zip_hash is None:
+            digest = hashlib.sha1()
+            with open(self._path, 'rb') as mzip:
+                for block in iter(lambda: mzip.read(1 << 20), b''):
+                    digest.update(block)
+            self._zip_hash = digest.hexdigest()
+        return self._zip_hash
+
+    def load_cached(self, kind, build):
+        """Return what build() reads from the zip, going through a cache file
+        in the cache directory if there is one. A cache file is used as long
+        as the zip's size and mtime match it, or failing that its hash.
+        """
+        if self._cache_dir is None:
+            return build()
+
+        cache_path = os.path.join(self._cache_dir,
+                                  '{0}.{1}.cache'.format(self._filename, kind))
+        stat = os.stat(self._path)
+
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as cachefile:
+                try:
+                    cached = marshal.load(cachefile)
+                except (EOFError, ValueError, TypeError):
+                    cached = None
+
+            if cached is not None and cached['version'] == self.CACHE_VERSION:
+                if (cached['size'], cached['mtime']) == (stat.st_size,
+                                                         stat.st_mtime):
+                    return cached['value']
+                if cached['sha1'] == self.zip_hash():
+                    # touched or copied, but the same zip
+                    self.write_cache(cache_path, stat, cached['value'])
+                    return cached['value']
+
+        value = build()
+        self.write_cache(cache_path, stat, value)
+        return value
+
+    def write_cache(self, cache_path, stat, value):
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as cachefile:
+            marshal.dump({'version': self.CACHE_VERSION,
+                          'size': stat.st_size,
+                          'mtime': stat.st_mtime,
+                          'sha1': self.zip_hash(),
+                          'value': value},
+                         cachefile, 2)
+        os.rename(tmp_path, cache_path)
 
     @property
     def data(self):
@@ -152,8 +793,9 @@ class Mapping:
     def dir(self):
         return self._dir
 
-    def write(self, output_dir):
+    def write(self, output_dir, filename=None):
         writeout_path = os.path.join(output_dir,
+                                     filename or
                                      self._resource_name+'.mapping')
         with open(writeout_path, 'w') as outfile:
             json.dump(self._data,
@@ -162,6 +804,102 @@ class Mapping:
                       sort_keys=True)
 
 
+class FieldnameMatcher:
+    """Picks the v4 node name closest to a v3 one. Answers are remembered
+    by (model, v3 name), so each name is only scored once a run, and
+    matches scoring under `threshold` are kept in low_confidence to be
+    reported. Subclasses supply the scoring in extract.
+    """
+
+    def __init__(self, threshold=None):
+        self._threshold = threshold
+        self._memo = {}
+        self._low_confidence = {}
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @property
+    def low_confidence(self):
+        """model -> {v3 name: {query, match, score}} for every match that
+        scored under the threshold
+        """
+        return self._low_confidence
+
+    def add_low_confidence(self, model, matches):
+        self._low_confidence.setdefault(model, {}).update(matches)
+
+    def extract(self, model, query, choices):
+        "the best of `choices` for `query`, and its score out of 100"
+        raise NotImplementedError
+
+    def match(self, model, v3_name, query, choices):
+        key = (model, v3_name)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+
+        v4_name, score = self.extract(model, query, choices)
+        self._memo[key] = v4_name
+
+        if self._threshold is not None and score < self._threshold:
+            self.add_low_confidence(model, {v3_name: {'query': query,
+                                                      'match': v4_name,
+                                                      'score': score}})
+        return v4_name
+
+
+class FuzzywuzzyMatcher(FieldnameMatcher):
+    # fuzzywuzzy's extractOne, as the migrator has always used
+
+    def extract(self, model, query, choices):
+        return process.extractOne(query, choices)
+
+
+class RapidfuzzMatcher(FieldnameMatcher):
+    """rapidfuzz's compiled WRatio. Each model's v4 node names are
+    normalized once, rather than on every comparison.
+    """
+
+    def __init__(self, threshold=None):
+        if rapid_process is None:
+            raise ImportError("the rapidfuzz matcher needs rapidfuzz "
+                              "installed")
+        FieldnameMatcher.__init__(self, threshold)
+        self._choices = {}
+
+    def extract(self, model, query, choices):
+        processed = self._choices.get(model)
+        if processed is None or len(processed) != len(choices):
+            processed = [rapid_utils.default_process(choice)
+                         for choice in choices]
+            self._choices[model] = processed
+
+        best = rapid_process.extractOne(rapid_utils.default_process(query),
+                                        processed,
+                                        scorer=rapid_fuzz.WRatio,
+                                        processor=None)
+        if best is None:
+            return choices[0], 0
+        return choices[best[2]], int(round(best[1]))
+
+
+MATCHERS = {
+    'fuzzywuzzy': FuzzywuzzyMatcher,
+    'rapidfuzz': RapidfuzzMatcher,
+}
+
+
+def get_matcher(name=None, threshold=None):
+    """fuzzywuzzy unless another matcher is named. rapidfuzz can pick a
+    different v4 name for the same v3 one, so it's never chosen just for
+    being installed.
+    """
+    return MATCHERS[name or 'fuzzywuzzy'](threshold)
+
+
 class DataConverter:
     """A DataConverter encasulates a v4 Resource Model Mapping and a
      Legion-generated graphdiff , and provides some calculated data
@@ -169,9 +907,11 @@ class DataConverter:
      v3 to v4.
     """
 
-    def __init__(self, mapping, graphdiff):
+    def __init__(self, mapping, graphdiff, matcher=None):
         self._graphdiff = graphdiff
         self._mapping = mapping
+        self._fieldname_table = None
+        self._matcher = matcher or get_matcher()
 
     @property
     def mapping(self):
@@ -189,33 +929,104 @@ class DataConverter:
     def graphdiff(self):
         return self._graphdiff
 
-    def get_datatype(self, node_name):
-        return self.mapping._node_datatypes[node_name]
+    @property
+    def matcher(self):
+        return self._matcher
 
-    def convert_v3_fieldname(self, field_name):
+    @property
+    def low_confidence(self):
+        "this model's v3 node names that were matched under the threshold"
+        return self.matcher.low_confidence.get(self.resource_name, {})
 
-        if field_name in self.graphdiff.data:
-            return process.extractOne(
-                self.graphdiff.data[field_name],
-                self.v4_fieldnames)[0]
+    def match_fieldname(self, v3_name, query):
+        # only the mapping's nodes; ResourceID isn't one, and has no
+        # datatype to convert a value with
+        return self.matcher.match(self.resource_name, v3_name, query,
+                                  self.mapping._fieldnames)
 
-            # return self.graphdiff.data[field_name]
+    def get_datatype(self, node_name):
+        "the node's v4 datatype, or None if it isn't in the mapping"
+        return self.mapping._node_datatypes.get(node_name)
+
+    @property
+    def fieldname_table(self):
+        """v3 entitytypeid -> v4 node name, built on first use"""
+        if self._fieldname_table is None:
+            self._fieldname_table = self.build_fieldname_table()
+        return self._fieldname_table
+
+    def build_fieldname_table(self):
+        """Resolve every graphdiff entry against the mapping's node list
+        once, so converting a node is a dict lookup rather than a
+        fuzzy match.
+        """
+        return {v3_name: self.match_fieldname(v3_name, v4_name)
+                for v3_name, v4_name in self.graphdiff.data.items()}
+
+    def load_fieldname_table(self, path):
+        """Use a table saved by a previous run. Entries pointing at nodes
+        that are no longer in the mapping are dropped, and graphdiff
+        entries missing from the file are resolved as usual.
+        """
+        v4_fieldnames = set(self.mapping._fieldnames)
+
+        with open(path, 'r') as infile:
+            table = {v3_name: v4_name for v3_name, v4_name in
+                     json.load(infile).items()
+                     if v4_name in v4_fieldnames}
+
+        for v3_name, v4_name in self.graphdiff.data.items():
+            if v3_name not in table:
+                table[v3_name] = self.match_fieldname(v3_name, v4_name)
+
+        self._fieldname_table = table
+
+    def merge_fieldname_table(self, table):
+        """Take on entries resolved elsewhere, by a worker process, without
+        building the table here first.
+        """
+        if self._fieldname_table is None:
+            self._fieldname_table = dict(table)
         else:
-            return process.extractOne(capwords(field_name
-                                               .split('.')[0]
-                                               .replace("_", " ")),
-                                      self.mapping.v4_fieldnames)[0]
+            self._fieldname_table.update(table)
+
+    def save_fieldname_table(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.fieldname_table,
+                      outfile,
+                      indent=4,
+                      sort_keys=True)
+
+    def convert_v3_fieldname(self, field_name):
+
+        try:
+            return self.fieldname_table[field_name]
+        except KeyError:
+            # not in the graphdiff; guess from the v3 name and remember
+            # the answer for the rest of the run
+            v4_name = self.match_fieldname(
+                field_name,
+                capwords(field_name.split('.')[0].replace("_", " ")))
+            self.fieldname_table[field_name] = v4_name
+            return v4_name
 
 
 class ResourceModelMigrator:
 
     # Migrates all resources in a Resource Model
 
-    def __init__(self, name, converter):
+    def __init__(self, name, converter, wkt_precision=None):
 
+        self._name = name
         self._converter = converter
-        self._resources = []
-        self._fixer = DTFixer()
+        self._fixer = DTFixer(ConceptResolver(converter.mapping),
+                              wkt_precision)
+        self._datatypes = self._fixer.datatypes
+        self._unresolved_nodes = {}
+
+    @property
+    def name(self):
+        return self._name
 
     @property
     def v4_name(self):
@@ -230,55 +1041,47 @@ class ResourceModelMigrator:
         return self._fixer
 
     @property
-    def resources(self):
-        return self._resources
-
-    def add_resource(self, resource):
-        self._resources.append(resource)
+    def unresolved_nodes(self):
+        """v3 name -> {v4 name: count} for the nodes left out because what
+        they matched has no datatype there's a fixer for
+        """
+        return self._unresolved_nodes
 
     def get_v4_rows(self, v4_nodes, resource_id):
         """condenses the input resource data into a set of rows that can be
-            written to the csv."""
+            written to the csv. The nth occurrence of a node goes in the nth
+            row, so this is a single pass over the nodes."""
 
-        resource = list(v4_nodes)
         outrows = []
+        occurrences = {}
         names,name_types = [],[]
 
-        while len(resource) > 0:
-            logger.debug("-"*80)
-            newrow = {u"ResourceID": resource_id}
-            added = []
-
-            for index, node in enumerate(resource):
-
-                node_name, value = node[0],node[1]
+        for node in v4_nodes:
 
-                ## pass the name and name types off into a different list
-                ## so they can be added to individual rows and primary can
-                ## always be first.
-                if node_name == "Name" or node_name == "Name Type":
-                    if node_name == "Name":
-                        names.append(node)
-                    else:
-                        name_types.append(node)
-                    added.append(index)
-                    continue
+            node_name, value = node[0],node[1]
 
-                if not node_name in newrow.keys():
-                    added.append(index)
+            ## pass the name and name types off into a different list
+            ## so they can be added to individual rows and primary can
+            ## always be first.
+            if node_name == "Name" or node_name == "Name Type":
+                if node_name == "Name":
+                    names.append(node)
+                else:
+                    name_types.append(node)
+                continue
 
-                    newrow[node_name] = value
+            index = occurrences.get(node_name, 0)
+            occurrences[node_name] = index + 1
 
-                    # encode to ascii only for logging
-                    v = value.encode('ascii', 'ignore')
-                    if len(v) > 50:
-                        v = v[:50]
-                    logger.debug("{}: {}".format(node_name, v))
+            if index == len(outrows):
+                outrows.append({u"ResourceID": resource_id})
 
-            outrows.append(newrow)
+            outrows[index][node_name] = value
 
-            ## strip out nodes that were just added and run the loop again
-            resource = [v for i,v in enumerate(resource) if not i in added]
+        ## a resource with nothing but names still gets a row of its own
+        ## ahead of the name rows
+        if not outrows and (names or name_types):
+            outrows.append({u"ResourceID": resource_id})
 
         ## creating special rows to handle name/name type to ensure that the
         ## primary name is the first row. this is for display name indexing.
@@ -292,10 +1095,12 @@ class ResourceModelMigrator:
             }
             if pair[1][1] == primary_uuid:
                 outrows.insert(0,newrow)
-                logger.debug(newrow)
             else:
                 outrows.append(newrow)
 
+        if tracer is not None and tracer.wants(resource_id):
+            tracer.trace(self.v4_name, resource_id, v4_nodes, outrows)
+
         return outrows
 
     def convert_v3_rows(self, v3_nodes):
@@ -303,49 +1108,79 @@ class ResourceModelMigrator:
         for node in v3_nodes:
             v4_name = self.converter.convert_v3_fieldname(node[0])
             datatype = self.converter.get_datatype(v4_name)
+            if datatype not in self._datatypes:
+                add_counts(self._unresolved_nodes, {node[0]: {v4_name: 1}})
+                continue
 
-            v4_value = self.fixer.fix_datatype(datatype, node[1])
+            v4_value = self.fixer.fix_datatype(datatype, node[1], v4_name)
 
             v4_nodes.append((v4_name, v4_value))
         return v4_nodes
 
-    def migrate(self):
-        rows = []
-        for resource in self.resources:
-            nodes = resource.nodes
-            rows += self.get_v4_rows(self.convert_v3_rows(nodes),
-                                     resource.resource_id)
-        return rows
-
-
-class Resource:
-    # knows its data and ID
-    def __init__(self, data):
-        self._uuid = data['entityid']
-        self._v3data = [data]
+    def report(self):
+        """what converting this model's resources has turned up, in a form
+        that can be sent back from a worker and merged with merge_report
+        """
+        return {
+            'fieldname_table': self.converter.fieldname_table,
+            'unparsed_dates': self.fixer.unparsed_dates,
+            'unresolved_concepts': self.fixer.resolver.unresolved,
+            'ambiguous_concepts': self.fixer.resolver.ambiguous,
+            'low_confidence_fieldnames': self.converter.low_confidence,
+            'invalid_geometries': self.fixer.wkt.invalid,
+            'unresolved_nodes': self.unresolved_nodes,
+        }
 
-        def process_children(children=self._v3data, processed=[]):
+    def merge_report(self, report):
+        self.converter.merge_fieldname_table(report['fieldname_table'])
+        self.fixer.add_unparsed_dates(report['unparsed_dates'])
+        add_counts(self.fixer.resolver.unresolved,
+                   report['unresolved_concepts'])
+        add_counts(self.fixer.resolver.ambiguous,
+                   report['ambiguous_concepts'])
+        self.converter.matcher.add_low_confidence(
+            self.v4_name, report['low_confidence_fieldnames'])
+        self.fixer.wkt.add_invalid(report['invalid_geometries'])
+        add_counts(self._unresolved_nodes, report['unresolved_nodes'])
+
+    def migrate_resource(self, resource):
+        return self.get_v4_rows(self.convert_v3_rows(resource.nodes),
+                                resource.resource_id)
+
+
+def iter_v3_nodes(data):
+    """Walk a v3 resource's entity tree with an explicit stack, yielding
+    (entitytypeid, value) for every entity that holds data. Entities come
+    out after their children, in the same order the old recursive walk
+    produced them.
+    """
+    stack = [(data, iter(data['child_entities']))]
 
-            for child in children:
-                grandchildren = child['child_entities']
+    while stack:
+        entity, children = stack[-1]
 
-                field_name = child['entitytypeid']
+        for child in children:
+            stack.append((child, iter(child['child_entities'])))
+            break
+        else:
+            stack.pop()
 
-                if len(grandchildren) > 0:
-                    process_children(grandchildren,
-                                     processed)
+            field_name = entity['entitytypeid']
 
-                field_data = child['value']
+            # don't attempt to migrate semantic nodes
+            if (field_name is not None and
+                    entity['businesstablename'] != ""):
+                yield field_name, entity['value']
 
-                # don't attempt to migrate semantic nodes
-                if (field_name is not None and
-                        child['businesstablename'] != ""):
 
-                    processed.append((
-                        field_name, field_data))
+class Resource(object):
+    # knows its data and ID. Only the flattened nodes are kept, not the v3
+    # data they came from.
+    __slots__ = ('_uuid', '_nodes')
 
-            return processed
-        self._nodes = process_children()
+    def __init__(self, data):
+        self._uuid = data['entityid']
+        self._nodes = tuple(iter_v3_nodes(data))
 
     @property
     def resource_id(self):
@@ -356,21 +1191,921 @@ class Resource:
         return self._nodes
 
 
+_RESOURCES_START = re.compile(r'"resources"\s*:\s*\[')
+
+
+def iter_v3_resources(path, chunk_size=1 << 20, start=None, offsets=False,
+                      spans=False):
+    """Yield the items of a v3 export's top-level `resources` array one at
+    a time, so that only the resource being decoded is held in memory
+    rather than the whole export.
+
+    With offsets=True, (resource, offset) pairs are yielded instead, where
+    offset is the byte offset in the file just past the resource. Passing
+    one of those offsets back as `start` picks the array up from there.
+    With spans=True, (resource, start, end) are yielded, the byte offsets
+    of the resource itself, which read_v3_resource can decode on its own.
+    """
+    offsets = offsets or spans
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    with open(path, 'rb') as opendata:
+
+        def read(size):
+            data = opendata.read(size)
+            return utf8.decode(data, not data)
+
+        buf = u''
+
+        if start is None:
+            while True:
+                match = _RESOURCES_START.search(buf)
+                if match is not None:
+                    break
+                chunk = read(chunk_size)
+                if not chunk:
+                    raise ValueError('no "resources" array in ' + path)
+                # keep a little of the old buffer in case the key straddles
+                # two chunks
+                buf = buf[-32:] + chunk
+
+            buf = buf[match.end():]
+            if offsets:
+                # bytes read, less what the decoder is holding on to and
+                # what's left in the buffer
+                start = (opendata.tell() - len(utf8.getstate()[0]) -
+                         len(buf.encode('utf-8')))
+        else:
+            opendata.seek(start)
+
+        byte_pos = start
+        pos = 0
+        eof = False
+
+        while True:
+            skipped = pos
+            while pos < len(buf) and buf[pos] in u' \t\r\n,':
+                pos += 1
+            if offsets:
+                byte_pos += pos - skipped
+
+            if pos < len(buf) and buf[pos] == u']':
+                return
+
+            if pos < len(buf):
+                try:
+                    resource, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    if offsets:
+                        resource_start = byte_pos
+                        byte_pos += len(buf[pos:end].encode('utf-8'))
+                        pos = end
+                        if spans:
+                            yield resource, resource_start, byte_pos
+                        else:
+                            yield resource, byte_pos
+                    else:
+                        pos = end
+                        yield resource
+                    continue
+
+            if eof:
+                raise ValueError('unterminated "resources" array in ' + path)
+
+            # the next resource isn't all in the buffer yet; read at least
+            # as much again as we're holding so that a very large resource
+            # isn't re-decoded once per chunk
+            chunk = read(max(chunk_size, len(buf) - pos))
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+def read_v3_resource(opendata, start, end):
+    "decode the resource between two offsets from iter_v3_resources(spans=True)"
+    opendata.seek(start)
+    return json.loads(opendata.read(end - start).decode('utf-8'))
+
+
+# the opening of a JSON object. a quote can't be left unescaped in a
+# string, so in a valid export this never matches inside one
+_OBJECT_START = re.compile(r'\{\s*"[A-Za-z_]+"\s*:')
+
+# what comes after an item of the resources array: another one or the end
+_RESOURCE_FOLLOWS = re.compile(r'\s*(?:,\s*(?=\{)|\])')
+
+# the rest of an export after its resources array
+_EXPORT_END = re.compile(r'\s*\}\s*$')
+
+
+def find_v3_resource(path, offset, models, run=3, window=1 << 20):
+    """The byte offset of the first resource in a v3 export that starts at
+    or after `offset`, which can fall anywhere in the file, or None if
+    there isn't one.
+
+    Resources are told apart from the entities nested in them by taking
+    `run` items in a row that each look like a resource, an object whose
+    entitytypeid is one of `models`, or fewer that run up to the end of
+    the export. An entity can have a resource model's entitytypeid, but a
+    list of them rarely does. That's still a guess, so check the offset
+    against the resource before it where that matters.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, 'rb') as opendata:
+        size = os.fstat(opendata.fileno()).st_size
+        opendata.seek(offset)
+        # left undecoded, so positions in it are byte offsets
+        buf = opendata.read(window)
+
+        def resources_from(pos):
+            """whether `pos` starts a run of resources, or None if more of
+            the file has to be read to tell
+            """
+            more = offset + len(buf) < size
+            for i in range(run):
+                if _OBJECT_START.match(buf, pos) is None:
+                    return None if more and len(buf) - pos < 64 else False
+                try:
+                    entity, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # a valid export only fails here when the object runs
+                    # past what's been read
+                    if more:
+                        return None
+                    raise
+
+                if not (isinstance(entity, dict) and
+                        'child_entities' in entity and
+                        entity.get('entitytypeid') in models):
+                    return False
+
+                follows = _RESOURCE_FOLLOWS.match(buf, end)
+                if more and len(buf) - end < 64 and \
+                   (follows is None or follows.group().endswith(']')):
+                    return None
+                if follows is None:
+                    return False
+                if follows.group().endswith(']'):
+                    return not more and \
+                        _EXPORT_END.match(buf, follows.end()) is not None
+                pos = follows.end()
+            return True
+
+        pos = 0
+        while True:
+            match = _OBJECT_START.search(buf, pos)
+            found = None if match is None else resources_from(match.start())
+            if found is None:
+                if offset + len(buf) >= size:
+                    return None
+                buf += opendata.read(len(buf))
+            elif found:
+                return offset + match.start()
+            else:
+                pos = match.start() + 1
+
+
+def v3_shards(path):
+    """The v3 export files `path` stands for: itself, the .json files in it
+    if it's a directory, or whatever it matches as a glob, sorted so that
+    shards are always read in the same order.
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, filename)
+                 for filename in os.listdir(path)
+                 if filename.endswith('.json')]
+    elif os.path.exists(path):
+        return [path]
+    else:
+        paths = glob.glob(path)
+
+    if not paths:
+        raise IOError("no v3 exports found at {0}".format(path))
+    return sorted(paths)
+
+
+class CSVWriter:
+    """Writes a resource model's CSV in batches. Rows are laid out against
+    the column order worked out up front, so only the cells a row
+    actually fills are touched, and a whole batch is encoded to UTF-8 in
+    one go before going through the csv module to a large write buffer,
+    gzipped if asked for.
+
+    unicodecsv's DictWriter, which this replaces, encoded each text field
+    on its own as utf-8-sig and so put a BOM in front of every one of
+    them. Arches reads each field back as utf-8-sig, so the same is done
+    here and the files come out byte for byte as they did before.
+    """
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path, fieldnames, resume_at=None, gzipped=False,
+                 batch_size=1000, fileobj=None):
+        if fileobj is not None:
+            self._raw = fileobj
+        elif resume_at is None:
+            self._raw = open(path, 'wb', self.BUFFER_SIZE)
+        else:
+            self._raw = open(path, 'r+b', self.BUFFER_SIZE)
+            self._raw.truncate(resume_at)
+            self._raw.seek(0, os.SEEK_END)
+
+        if gzipped:
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        else:
+            self._file = self._raw
+
+        self._writer = stdcsv.writer(self._file)
+        self._fieldnames = fieldnames
+        self._columns = {name: index for index, name in
+                         enumerate(fieldnames)}
+        self._batch = []
+        self._batch_size = batch_size
+
+    @property
+    def fieldnames(self):
+        return self._fieldnames
+
+    def writeheader(self):
+        self.writerow(dict(zip(self._fieldnames, self._fieldnames)))
+
+    def writerow(self, row):
+        cells = [u''] * len(self._fieldnames)
+        columns = self._columns
+        try:
+            for name, value in row.iteritems():
+                cells[columns[name]] = csv_text(value)
+        except KeyError as error:
+            raise ValueError("row has a field that isn't in the CSV: "
+                             "{0!r}".format(error.args[0]))
+
+        self._batch.append(cells)
+        if len(self._batch) >= self._batch_size:
+            self.write_batch()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self):
+        if not self._batch:
+            return
+
+        width = len(self._fieldnames)
+        cells = [cell for row in self._batch for cell in row]
+        encoded = u'\x00'.join(cells).encode('utf-8').split('\x00')
+        if len(encoded) != len(cells):
+            # a NUL in the data; encode this batch cell by cell instead
+            encoded = [cell.encode('utf-8') for cell in cells]
+
+        self._writer.writerows(encoded[i:i + width]
+                               for i in range(0, len(encoded), width))
+        self._batch = []
+
+    def copy_from(self, fileobj):
+        "append the contents of an already encoded CSV file"
+        self.write_batch()
+        shutil.copyfileobj(fileobj, self._file)
+
+    def flush(self):
+        self.write_batch()
+        self._file.flush()
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def tell(self):
+        return self._raw.tell()
+
+    def close(self):
+        self.write_batch()
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def csv_text(value):
+    "a cell's text the way unicodecsv's utf-8-sig DictWriter wrote it"
+    if isinstance(value, unicode):
+        return u'\ufeff' + value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if value is None:
+        return u''
+    if isinstance(value, float):
+        # the csv module writes floats with repr
+        return unicode(repr(value))
+    return unicode(value)
+
+
+class ShardedCSVWriter:
+    """Writes a resource model's CSV as a series of shards, each of at most
+    max_rows rows and max_bytes bytes (uncompressed, header included),
+    named `<model>.0001.csv` and so on, with its own header and a copy of
+    the .mapping beside it so each can be imported on its own.
+
+    Every writerows call is taken to be all of one resource's rows, which
+    always go in the same shard; a resource too big for a shard on its own
+    gets a shard to itself.
+    """
+
+    def __init__(self, directory, name, mapping, fieldnames, suffix='.csv',
+                 max_rows=None, max_bytes=None, gzipped=False):
+        self._dir = directory
+        self._name = name
+        self._mapping = mapping
+        self._suffix = suffix
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._gzip = gzipped
+        self._shards = []
+        self._raw = None
+        self._file = None
+
+        # resources are laid out and encoded here first, to find out how
+        # many bytes they come to
+        self._buffer = cStringIO.StringIO()
+        self._staging = CSVWriter(None, fieldnames, fileobj=self._buffer)
+        self._staging.writeheader()
+        self._header = self.take_staged()
+
+    @property
+    def fieldnames(self):
+        return self._staging.fieldnames
+
+    @property
+    def shards(self):
+        """[{'csv', 'mapping', 'resources', 'rows', 'bytes'}] for each
+        shard written so far
+        """
+        return self._shards
+
+    def take_staged(self):
+        self._staging.write_batch()
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def writeheader(self):
+        "each shard gets its header when it's opened"
+        pass
+
+    def writerows(self, rows):
+        self._staging.writerows(rows)
+        self.add_resource(len(rows), self.take_staged())
+
+    def copy_from(self, fileobj):
+        """append a headerless CSV, as written by CSVWriter, splitting it
+        between resources
+        """
+        writer = stdcsv.writer(self._buffer)
+        for resource_id, rows in itertools.groupby(stdcsv.reader(fileobj),
+                                                   lambda row: row[0]):
+            rows = list(rows)
+            writer.writerows(rows)
+            self.add_resource(len(rows), self.take_staged())
+
+    def add_resource(self, rows, data):
+        shard = self._shards[-1] if self._shards else None
+        if shard is None or shard['resources'] and (
+                self._max_rows is not None and
+                shard['rows'] + rows > self._max_rows or
+                self._max_bytes is not None and
+                shard['bytes'] + len(data) > self._max_bytes):
+            shard = self.open_shard()
+
+        self._file.write(data)
+        shard['resources'] += 1
+        shard['rows'] += rows
+        shard['bytes'] += len(data)
+
+    def open_shard(self):
+        self.close()
+
+        csv_name = u'{0}.{1:04d}{2}'.format(self._name,
+                                            len(self._shards) + 1,
+                                            self._suffix)
+        mapping_name = re.sub(r'\.csv(\.gz)?$', '.mapping', csv_name)
+        self._mapping.write(self._dir, mapping_name)
+
+        self._raw = open(os.path.join(self._dir, csv_name), 'wb',
+                         CSVWriter.BUFFER_SIZE)
+        if self._gzip:
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        else:
+            self._file = self._raw
+        self._file.write(self._header)
+
+        shard = {'csv': csv_name, 'mapping': mapping_name,
+                 'resources': 0, 'rows': 0, 'bytes': len(self._header)}
+        self._shards.append(shard)
+        return shard
+
+    def close(self):
+        if self._raw is None:
+            return
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+        self._raw = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnWriter:
+    """Spills the converted nodes of one resource model to disk column-wise
+    rather than as (v4 name, value) tuples. Node names are interned to
+    their column in the model's CSV, and values go into one blob with an
+    array of end offsets and a type code each. Every resource takes a
+    node in column 0 (ResourceID) for its id, and `starts` records where
+    each resource's nodes begin. ColumnReader reads the files back.
+    """
+
+    VERSION = 1
+
+    # (file, array typecode)
+    ARRAYS = [('starts', 'L'), ('columns', 'I'), ('types', 'B'),
+              ('ends', 'L')]
+
+    # what each value was, so it comes back as the same type and the CSV
+    # comes out the same
+    NONE, BYTES, TEXT = 0, 1, 2
+
+    def __init__(self, directory, name, fieldnames, batch_size=1000):
+        self._prefix = os.path.join(directory, name)
+        self._name = name
+        self._fieldnames = fieldnames
+        self._index = {field: i for i, field in enumerate(fieldnames)}
+        self._batch_size = batch_size
+        self._resources = 0
+        self._nodes = 0
+        self._bytes = 0
+
+        self._arrays = {key: array(code) for key, code in self.ARRAYS}
+        self._values = []
+        self._files = {key: open(self._prefix + '.' + key, 'wb')
+                       for key, code in self.ARRAYS + [('values', None)]}
+
+    def append(self, resource_id, v4_nodes):
+        self._arrays['starts'].append(self._nodes)
+        self.add_value(0, resource_id)
+
+        index = self._index
+        for node_name, value in v4_nodes:
+            self.add_value(index[node_name], value)
+
+        self._resources += 1
+        if len(self._arrays['starts']) >= self._batch_size:
+            self.flush()
+
+    def add_value(self, column, value):
+        if value is None:
+            kind, data = self.NONE, ''
+        elif isinstance(value, unicode):
+            kind, data = self.TEXT, value.encode('utf-8')
+        elif isinstance(value, float):
+            # the csv module writes floats with repr
+            kind, data = self.BYTES, repr(value)
+        else:
+            kind, data = self.BYTES, str(value)
+
+        self._nodes += 1
+        self._bytes += len(data)
+        self._arrays['columns'].append(column)
+        self._arrays['types'].append(kind)
+        self._arrays['ends'].append(self._bytes)
+        self._values.append(data)
+
+    def flush(self):
+        for key, code in self.ARRAYS:
+            self._arrays[key].tofile(self._files[key])
+            self._arrays[key] = array(code)
+        self._files['values'].write(''.join(self._values))
+        self._values = []
+
+    def discard(self):
+        """Close and delete the files written so far, for a spill that
+        stopped partway; without the metadata close writes, ColumnReader
+        won't take what's left for a finished store.
+        """
+        for key, outfile in self._files.items():
+            outfile.close()
+            os.remove(self._prefix + '.' + key)
+
+    def close(self):
+        self.flush()
+        for outfile in self._files.values():
+            outfile.close()
+
+        with open(self._prefix + '.columns.json', 'w') as outfile:
+            json.dump({'version': self.VERSION,
+                       'name': self._name,
+                       'fieldnames': self._fieldnames,
+                       'resources': self._resources,
+                       'nodes': self._nodes,
+                       'itemsizes': {key: array(code).itemsize
+                                     for key, code in self.ARRAYS}},
+                      outfile,
+                      indent=4,
+                      sort_keys=True)
+
+
+class ColumnReader:
+    """Reads a model written by ColumnWriter back a resource at a time,
+    through memory maps, as (resource id, [(v4 name, value), ...]).
+    """
+
+    def __init__(self, directory, name):
+        self._prefix = os.path.join(directory, name)
+
+        if not os.path.exists(self._prefix + '.columns.json'):
+            raise ValueError("{0} is not a finished column store; the spill "
+                             "that wrote it stopped partway".format(
+                                 self._prefix))
+
+        with open(self._prefix + '.columns.json', 'r') as infile:
+            self._meta = json.load(infile)
+
+        sizes = {key: array(code).itemsize
+                 for key, code in ColumnWriter.ARRAYS}
+        if self._meta['version'] != ColumnWriter.VERSION or \
+           self._meta['itemsizes'] != sizes:
+            raise ValueError("{0} was written by a different version or "
+                             "platform".format(self._prefix))
+
+    @property
+    def name(self):
+        return self._meta['name']
+
+    @property
+    def fieldnames(self):
+        return self._meta['fieldnames']
+
+    @property
+    def resources(self):
+        return self._meta['resources']
+
+    def mapped(self, key):
+        with open(self._prefix + '.' + key, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return ''
+            return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        if not self.resources:
+            return
+
+        codes = dict(ColumnWriter.ARRAYS)
+        maps = {key: self.mapped(key)
+                for key in ['columns', 'types', 'ends', 'values']}
+        sizes = {key: array(code).itemsize for key, code in codes.items()}
+
+        starts = array(codes['starts'])
+        with open(self._prefix + '.starts', 'rb') as infile:
+            starts.fromfile(infile, self.resources)
+        starts.append(self._meta['nodes'])
+
+        def read(key, first, last):
+            values = array(codes[key])
+            values.fromstring(maps[key][first * sizes[key]:
+                                        last * sizes[key]])
+            return values
+
+        fieldnames = self.fieldnames
+        values = maps['values']
+        end = 0
+        try:
+            for first, last in zip(starts, starts[1:]):
+                nodes = []
+                for column, kind, stop in zip(read('columns', first, last),
+                                              read('types', first, last),
+                                              read('ends', first, last)):
+                    if kind == ColumnWriter.NONE:
+                        value = None
+                    elif kind == ColumnWriter.TEXT:
+                        value = values[end:stop].decode('utf-8')
+                    else:
+                        value = values[end:stop]
+                    end = stop
+                    nodes.append((fieldnames[column], value))
+
+                yield nodes[0][1], nodes[1:]
+        finally:
+            for mapped in maps.values():
+                if mapped:
+                    mapped.close()
+
+
+# lists the models the last finished spill into a column store wrote
+COLUMN_STORE_MANIFEST = 'column_store.json'
+
+
+def column_store_models(directory):
+    "the v3 resource models the last finished spill into `directory` wrote"
+    path = os.path.join(directory, COLUMN_STORE_MANIFEST)
+    if not os.path.exists(path):
+        raise ValueError("{0} holds no finished column store; run again "
+                         "without --output-only".format(directory))
+
+    with open(path, 'r') as infile:
+        return sorted(json.load(infile)['models'])
+
+
+def write_column_store_manifest(directory, models):
+    with open(os.path.join(directory, COLUMN_STORE_MANIFEST), 'w') as outfile:
+        json.dump({'version': ColumnWriter.VERSION, 'models': sorted(models)},
+                  outfile, indent=4, sort_keys=True)
+
+
+def remove_column_store(directory):
+    """Delete a column store left in `directory` by an earlier spill, so
+    models missing from the next export aren't written from stale data.
+    """
+    suffixes = tuple(['.columns.json'] +
+                     ['.' + key for key, code in ColumnWriter.ARRAYS] +
+                     ['.values'])
+    for filename in sorted(os.listdir(directory)):
+        if filename == COLUMN_STORE_MANIFEST or filename.endswith(suffixes):
+            os.remove(os.path.join(directory, filename))
+
+
+class Checkpoint:
+    """Records how far a migration has got so that a rerun after a crash
+    can pick up where it stopped.
+
+    A serial run saves the byte offset in the v3 export that everything
+    before has been written, and each model's CSV size, resource count and
+    first and last ResourceID at that point. A --workers run saves the
+    chunks that have been written and the models whose chunks have been
+    merged. Either way the migrators' reports are saved along with them,
+    so that a resumed run still reports on the resources it didn't
+    convert itself.
+    """
+
+    def __init__(self, path, v3_file, models_to_use, chunk_size=None):
+        self._path = path
+        stat = os.stat(v3_file)
+        source = {
+            'v3_file': os.path.abspath(v3_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'models': sorted(models_to_use),
+            'chunk_size': chunk_size,
+        }
+        self._data = {
+            'source': source,
+            'complete': False,
+            'v3_offset': None,
+            'models': {},
+            'parts': {},
+            'merged': [],
+            'reports': {},
+        }
+        self._resumed = False
+
+        if os.path.exists(path):
+            with open(path, 'r') as infile:
+                data = json.load(infile)
+            if data['source'] == source:
+                self._data = data
+                self._resumed = True
+            else:
+                logger.warning("{0} is for a different v3 export or set of "
+                               "options, starting over".format(path))
+
+    @property
+    def resumed(self):
+        "whether this picks up an earlier run's progress"
+        return self._resumed
+
+    @property
+    def complete(self):
+        return self._data['complete']
+
+    @property
+    def v3_offset(self):
+        return self._data['v3_offset']
+
+    @property
+    def models(self):
+        "v3 model name -> {csv, csv_bytes, resources, first_id, last_id}"
+        return self._data['models']
+
+    @property
+    def parts(self):
+        "partial CSV filename -> [v3 model name, migrator report]"
+        return self._data['parts']
+
+    @property
+    def merged(self):
+        return self._data['merged']
+
+    @property
+    def reports(self):
+        "v3 model name -> migrator report, as of v3_offset"
+        return self._data['reports']
+
+    def add_part(self, filename, name, report):
+        self._data['parts'][filename] = [name, report]
+        self.save()
+
+    def add_merged(self, name):
+        self._data['merged'].append(name)
+        self.save()
+
+    def add_resource(self, name, csv_name, resource_id):
+        model = self.models.get(name)
+        if model is None:
+            model = self.models[name] = {'csv': csv_name,
+                                         'csv_bytes': 0,
+                                         'resources': 0,
+                                         'first_id': resource_id}
+        model['resources'] += 1
+        model['last_id'] = resource_id
+
+    def update(self, v3_offset, writers, reports):
+        """Save the position in the v3 export that has been written up to,
+        along with the size of the CSVs in `writers` (v3 model name ->
+        CSVWriter) and the migrators' `reports` (v3 model name -> report)
+        at that point.
+        """
+        for name, writer in writers.items():
+            writer.flush()
+            os.fsync(writer.fileno())
+            self.models[name]['csv_bytes'] = writer.tell()
+        self._data['v3_offset'] = v3_offset
+        self._data['reports'] = reports
+        self.save()
+
+    def finish(self):
+        self._data['complete'] = True
+        self.save()
+
+    def save(self):
+        # write and rename so a crash never leaves half a checkpoint
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self._data,
+                      outfile,
+                      indent=4,
+                      sort_keys=True)
+        os.rename(tmp_path, self._path)
+
+
+class DeltaState:
+    """Content hashes of the resources a previous run migrated, keyed by v3
+    resource model and entityid, so that the next run can migrate only the
+    resources that are new or have changed and list the ones that have
+    gone.
+
+    A resource's hash covers its flattened nodes, which is everything that
+    ends up in the CSV. A change to the graphdiffs or mappings isn't
+    noticed, so start from a fresh state file after one.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._previous = None
+        self._current = {}
+        self._counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+
+        if os.path.exists(path):
+            with open(path, 'r') as infile:
+                self._previous = json.load(infile)
+
+    @property
+    def is_delta(self):
+        "whether there was a previous run to compare against"
+        return self._previous is not None
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def resource_hash(self, resource):
+        content = json.dumps([resource.resource_id, resource.nodes],
+                             separators=(',', ':'))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+    def changed(self, name, resource):
+        """Record a resource's hash and return whether it needs migrating
+        """
+        digest = self.resource_hash(resource)
+        self._current.setdefault(name, {})[resource.resource_id] = digest
+
+        if self._previous is None:
+            return True
+
+        previous = self._previous.get(name, {}).get(resource.resource_id)
+        if previous is None:
+            self._counts['new'] += 1
+        elif previous != digest:
+            self._counts['changed'] += 1
+        else:
+            self._counts['unchanged'] += 1
+            return False
+        return True
+
+    def deleted(self, use_model):
+        """(v3 model name, entityid) for every resource of the models this
+        run covered that was in the previous run but not this one
+        """
+        if self._previous is None:
+            return []
+        return sorted((name, resource_id)
+                      for name, hashes in self._previous.items()
+                      if use_model(name)
+                      for resource_id in hashes
+                      if resource_id not in self._current.get(name, {}))
+
+    def save(self, use_model):
+        # models this run didn't cover keep their previous hashes
+        state = dict(self._current)
+        if self._previous is not None:
+            for name, hashes in self._previous.items():
+                if not use_model(name):
+                    state[name] = hashes
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(state,
+                      outfile,
+                      separators=(',', ':'),
+                      sort_keys=True)
+        os.rename(tmp_path, self._path)
+
+
 class Migration:
     # this class handles details like the resource/output locations,
     # configuration, IO, and worker spawning
 
+    # the smallest byte range of an export scan_v3_shards gives a worker
+    SCAN_RANGE_MIN = 1 << 20
+
     def __init__(self, v3_file, mappings_dir, output_dir, models_to_use,
-                 config=".migrator_config.json"):
+                 config=".migrator_config.json", fieldname_tables=None,
+                 checkpoint_every=None, delta_state=None,
+                 mapping_cache=None, gzip_output=False, matcher=None,
+                 match_threshold=None, columns_dir=None, shard_rows=None,
+                 shard_size=None, wkt_precision=None):
+        self._v3_file = v3_file
+        self._v3_files = v3_shards(v3_file) if v3_file is not None else []
+        self._mappings_dir = mappings_dir
         self._output_dir = output_dir
         self._resource_models = {}
+        self._migrators = {}
         self._models_to_use = models_to_use
+        self._fieldname_tables = fieldname_tables
+        self._mapping_cache = mapping_cache
+        self._checkpoint_every = checkpoint_every
+        self._v3_offset = None
+        self._delta = None
+        self._csv_suffix = '.csv'
+        self._gzip = gzip_output
+        self._matcher = get_matcher(matcher, match_threshold)
+        self._columns_dir = columns_dir
+        self._shard_rows = shard_rows
+        self._shard_size = shard_size
+        self._output_shards = {}
+        self._wkt_precision = wkt_precision
+
+        if delta_state is not None:
+            self._delta = DeltaState(delta_state)
+            if self._delta.is_delta:
+                self._csv_suffix = '.delta.csv'
+
+        if gzip_output:
+            self._csv_suffix += '.gz'
+
+        if fieldname_tables is not None and \
+           not os.path.exists(fieldname_tables):
+            os.makedirs(fieldname_tables)
+
+        if mapping_cache is not None and not os.path.exists(mapping_cache):
+            os.makedirs(mapping_cache)
+
+        if columns_dir is not None and not os.path.exists(columns_dir):
+            os.makedirs(columns_dir)
 
         with open(config, 'r') as config:
             self._config = json.load(config)
 
-        self.import_v3_resources(v3_file, mappings_dir)
-
     @property
     def resource_models(self):
         return self._resource_models
@@ -379,59 +2114,1258 @@ class Migration:
     def models_to_use(self):
         return self._models_to_use
 
-    def import_v3_resources(self, v3_file, mappings_dir):
+    @property
+    def shard_output(self):
+        "whether each model's CSV is split into shards"
+        return self._shard_rows is not None or self._shard_size is not None
 
-        v3_sorted = {}
-        namediffs = self._config['namediffs']
+    @property
+    def manifest_path(self):
+        return os.path.join(self._output_dir, 'import_manifest.json')
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self._output_dir, 'migration_checkpoint.json')
+
+    def fieldname_table_path(self, converter):
+        if self._fieldname_tables is None:
+            return None
+        return os.path.join(self._fieldname_tables,
+                            converter.resource_name + '.fieldnames.json')
+
+    def use_model(self, entitytypeid):
+        return "<all>" in self.models_to_use or \
+            entitytypeid in self.models_to_use
+
+    def mapping_path(self, name):
+        return os.path.join(self._mappings_dir,
+                            self._config['namediffs'][name] + ".zip")
+
+    def build_migrator(self, name):
         graphdiffs = self._config['graphdiffs']
         graphdiff_path = self._config['graphdiff_path']
 
-        with open(v3_file, 'rb') as opendata:
-            v3_data = json.load(opendata)
+        graphdiff = GraphDiff(name, graphdiff_path +
+                              graphdiffs[name])
+        mapping = Mapping(self.mapping_path(name), self._mapping_cache)
+        converter = DataConverter(mapping, graphdiff, self._matcher)
 
-            for r in v3_data['resources']:
+        table_path = self.fieldname_table_path(converter)
+        if table_path is not None and os.path.exists(table_path):
+            converter.load_fieldname_table(table_path)
 
-                entitytypeid = r['entitytypeid']
+        return ResourceModelMigrator(name, converter, self._wkt_precision)
 
-                if "<all>" not in self.models_to_use and \
-                   entitytypeid not in self.models_to_use:
-                    continue
+    def get_migrator(self, name):
+        "the migrator for a v3 resource model, built the first time it's used"
+        migrator = self._migrators.get(name)
+        if migrator is None:
+            migrator = self.build_migrator(name)
+            self._migrators[name] = migrator
+            self._resource_models[migrator.v4_name] = migrator
+        return migrator
 
-                if not entitytypeid in v3_sorted.keys():
-                    v3_sorted[entitytypeid] = [r]
+    @property
+    def sharded(self):
+        "whether the export is split over more than one file"
+        return len(self._v3_files) > 1
+
+    def read_v3_resources(self, start=None):
+        """Stream every shard of the export in turn, yielding (resource
+        dict, byte offset just past it in its shard). When there's more
+        than one shard, a resource whose entityid has already been read is
+        left out, so the first shard to have it wins.
+
+        start is a byte offset to pick up from in a single file export.
+        """
+        seen = set()
+        for path in self._v3_files:
+            for r, offset in iter_v3_resources(path, start=start,
+                                               offsets=True):
+                if self.sharded:
+                    if r['entityid'] in seen:
+                        continue
+                    seen.add(r['entityid'])
+                yield r, offset
+
+    def import_v3_resources(self, start=None):
+        """Stream the v3 export, yielding (migrator, Resource) pairs in file
+        order. A resource model's migrator is built the first time one of
+        its resources turns up.
+
+        start is a byte offset in the export to pick up from. The offset
+        just past the latest resource is kept in _v3_offset.
+        """
+        for r, offset in self.read_v3_resources(start):
+
+            entitytypeid = r['entitytypeid']
+
+            if not self.use_model(entitytypeid):
+                continue
+
+            migrator = self.get_migrator(entitytypeid)
+
+            resource = Resource(r)
+            del r
+            self._v3_offset = offset
+            yield migrator, resource
+
+    def open_writer(self, migrator, resume_at=None):
+        """Open a model's CSV and write its header and .mapping, or with
+        resume_at, truncate an existing CSV to that many bytes and append
+        to it.
+        """
+        if self.shard_output and resume_at is None:
+            writer = ShardedCSVWriter(self._output_dir, migrator.v4_name,
+                                      migrator.converter.mapping,
+                                      migrator.converter.v4_fieldnames,
+                                      self._csv_suffix, self._shard_rows,
+                                      self._shard_size, self._gzip)
+            self._output_shards[migrator.v4_name] = writer.shards
+            return writer
+
+        filename = os.path.join(self._output_dir,
+                                migrator.v4_name + self._csv_suffix)
+
+        if resume_at is None:
+            migrator.converter.mapping.write(self._output_dir)
+
+        writer = CSVWriter(filename, migrator.converter.v4_fieldnames,
+                           resume_at=resume_at, gzipped=self._gzip)
+        if resume_at is None:
+            writer.writeheader()
+        return writer
+
+    def write_rows(self, writer, rows):
+        writer.writerows(rows)
+
+    def count_v3_resources(self, shard=0, start=None, stop=None,
+                           find=False):
+        """The number of resources of each model starting between byte
+        offsets start and stop of one shard of the export (its whole
+        resources array when they're None), the byte span of each of them
+        in file order (flattened into an array of start, end, start,
+        end...) so that a chunk can go straight to its own resources, and,
+        for a sharded export, the (model, entityid) of every resource in
+        file order, for working out duplicates.
+
+        With find=True, start needn't be where a resource starts, and the
+        count begins at the first one found after it with
+        find_v3_resource. Returns (begin, counts, spans, entityids, after),
+        begin and after being the offsets of the first resource counted
+        and the first one past stop, or None, so that ranges counted
+        separately can be checked to meet.
+        """
+        path = self._v3_files[shard]
+        counts = {}
+        spans = {}
+        entityids = [] if self.sharded else None
+        begin = after = None
+
+        if find:
+            start = find_v3_resource(path, start, self._config['namediffs'])
+            if start is None:
+                return begin, counts, spans, entityids, after
+
+        for r, r_start, end in iter_v3_resources(path, start=start,
+                                                 spans=True):
+            if begin is None:
+                begin = r_start
+            if stop is not None and r_start >= stop:
+                after = r_start
+                break
+
+            entitytypeid = r['entitytypeid']
+            if self.use_model(entitytypeid):
+                counts[entitytypeid] = counts.get(entitytypeid, 0) + 1
+                model_spans = spans.get(entitytypeid)
+                if model_spans is None:
+                    model_spans = spans[entitytypeid] = array('L')
+                model_spans.append(r_start)
+                model_spans.append(end)
+                if entityids is not None:
+                    entityids.append((entitytypeid, r['entityid']))
+        return begin, counts, spans, entityids, after
+
+    def scan_v3_shards(self, workers):
+        """Count every shard's resources by model and find the resources
+        that are duplicates of one read earlier. Returns {(shard, model):
+        (count, spans, skip)}, spans being as from count_v3_resources and
+        skip the positions, among that model's resources in that shard, of
+        the duplicates to leave out.
+
+        Each shard is split into up to `workers` byte ranges, counted in
+        parallel, so that a single large export isn't decoded by one
+        process while the rest wait.
+        """
+        tasks = []
+        for shard, path in enumerate(self._v3_files):
+            size = os.path.getsize(path)
+            n = max(1, min(workers, size // self.SCAN_RANGE_MIN))
+            bounds = [None] + [size * k // n for k in range(1, n)] + [None]
+            for k in range(n):
+                tasks.append((self, shard, bounds[k], bounds[k + 1], k > 0))
+
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            ranges = pool.map(_count_v3_resources, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = []
+        for task, result in zip(tasks, ranges):
+            shard, start, stop, find = task[1:]
+            if not find:
+                results.append(result[1:4])
+                after = result[4]
+                continue
+
+            counts, spans, entityids = results[-1]
+            if result[0] != after:
+                # the range was guessed to start somewhere else than where
+                # the one before it ended; count it again from there
+                result = self.count_v3_resources(shard, after, stop) \
+                    if after is not None else (None, {}, {}, [], None)
+            after = result[4]
+
+            for name, count in result[1].items():
+                counts[name] = counts.get(name, 0) + count
+                spans.setdefault(name, array('L')).extend(result[2][name])
+            if entityids is not None:
+                entityids.extend(result[3])
+
+        scanned = {}
+        seen = set()
+        for shard, (counts, spans, entityids) in enumerate(results):
+            skips = dict((name, set()) for name in counts)
+            positions = {}
+            for name, entityid in entityids or []:
+                position = positions.get(name, 0)
+                positions[name] = position + 1
+                if entityid in seen:
+                    skips[name].add(position)
                 else:
-                    v3_sorted[entitytypeid].append(r)
+                    seen.add(entityid)
+
+            for name, count in counts.items():
+                scanned[(shard, name)] = (count, spans[name],
+                                          frozenset(skips[name]))
+        return scanned
+
+    def migrate_part(self, name, start, stop, path, shard=0, skip=(),
+                     spans=None, fieldname_table=None):
+        """Write the rows of one resource model's resources start to stop
+        (counted in file order) in one shard of the export to a headerless
+        partial CSV, leaving out those whose positions are in `skip`, and
+        return the field name table the converter ended up with. The part
+        only appears under `path` once it's complete.
+
+        spans are the byte spans of just these resources, from
+        count_v3_resources, so that only they are decoded, and
+        fieldname_table a table resolved already, so that the node names
+        aren't matched again in every part.
+        """
+        migrator = self.build_migrator(name)
+        if fieldname_table is not None:
+            migrator.converter.merge_fieldname_table(fieldname_table)
+
+        with CSVWriter(path + '.tmp',
+                       migrator.converter.v4_fieldnames) as writer, \
+                open(self._v3_files[shard], 'rb') as opendata:
+            for index in range(start, stop):
+                if index in skip:
+                    continue
+                r = read_v3_resource(opendata, spans[2 * (index - start)],
+                                     spans[2 * (index - start) + 1])
+                self.write_rows(writer,
+                                migrator.migrate_resource(Resource(r)))
+
+        os.rename(path + '.tmp', path)
+
+        return name, migrator.report()
+
+    def save_fieldname_tables(self):
+        for migrator in self._resource_models.itervalues():
+            table_path = self.fieldname_table_path(migrator.converter)
+            if table_path is not None:
+                migrator.converter.save_fieldname_table(table_path)
+
+    def report_concepts(self):
+        """Log a summary of the concept values that couldn't be resolved to
+        UUIDs, and write them all to unresolved_concepts.json in the output
+        directory.
+        """
+        report = {}
+        for rm_name, migrator in sorted(self._resource_models.items()):
+            resolver = migrator.fixer.resolver
+            if not (resolver.unresolved or resolver.ambiguous):
+                continue
+
+            report[rm_name] = {'unresolved': resolver.unresolved,
+                               'ambiguous': resolver.ambiguous}
+            for kind, nodes in sorted(report[rm_name].items()):
+                for node_name, values in sorted(nodes.items()):
+                    logger.warning(
+                        u"{0}: {1} {2} values of {3} in {4} different forms, "
+                        u"e.g. {5}".format(
+                            rm_name, sum(values.values()), kind, node_name,
+                            len(values), u", ".join(sorted(values)[:5])))
+
+        path = os.path.join(self._output_dir, 'unresolved_concepts.json')
+        if report:
+            with open(path, 'w') as outfile:
+                json.dump(report,
+                          outfile,
+                          indent=4,
+                          sort_keys=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def report_fieldname_matches(self):
+        """Log the v3 node names whose v4 match scored under the threshold,
+        and write them to low_confidence_fieldnames.json in the output
+        directory for checking by hand.
+        """
+        report = {}
+        for rm_name, migrator in sorted(self._resource_models.items()):
+            matches = migrator.converter.low_confidence
+            if not matches:
+                continue
+
+            report[rm_name] = matches
+            for v3_name, match in sorted(matches.items()):
+                logger.warning(
+                    u"{0}: {1} matched to {2} with a score of only "
+                    u"{3}".format(rm_name, v3_name, match['match'],
+                                  match['score']))
+
+        path = os.path.join(self._output_dir,
+                            'low_confidence_fieldnames.json')
+        if report:
+            with open(path, 'w') as outfile:
+                json.dump(report,
+                          outfile,
+                          indent=4,
+                          sort_keys=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def log_unresolved_nodes(self):
+        for rm_name, migrator in sorted(self._resource_models.items()):
+            for v3_name, matches in sorted(
+                    migrator.unresolved_nodes.items()):
+                for v4_name, n in sorted(matches.items()):
+                    logger.warning(
+                        u"{0}: {1} {2} nodes were left out; they matched "
+                        u"{3}, which has no datatype the migrator "
+                        u"converts".format(rm_name, n, v3_name, v4_name))
+
+    def log_unparsed_dates(self):
+        for rm_name, migrator in sorted(self._resource_models.items()):
+            unparsed = migrator.fixer.unparsed_dates
+            if not unparsed['count']:
+                continue
+
+            logger.warning(
+                u"{0}: {1} date values couldn't be parsed and were left as "
+                u"they were, e.g. {2}".format(
+                    rm_name, unparsed['count'],
+                    u", ".join(sorted(unparsed['sample'])[:10])))
+            for value, n in sorted(unparsed['sample'].items()):
+                logger.debug(u"unparsed date {0!r} x{1}".format(value, n))
+
+    def check_model(self, name, problems):
+        """Check that a v3 resource model has everything a migration needs
+        from the config, its graphdiff and its mapping, adding anything
+        missing to `problems`. Returns the model's DataConverter and v3
+        entitytypeid -> v4 datatype for every graphdiff entry, going by the
+        node the entry will really be converted to (None where that isn't
+        a node in the mapping), or None if the model can't be migrated at
+        all.
+        """
+        namediffs = self._config['namediffs']
+        graphdiffs = self._config['graphdiffs']
+
+        missing = [key for key, diffs in [('namediffs', namediffs),
+                                          ('graphdiffs', graphdiffs)]
+                   if name not in diffs]
+        if missing:
+            problems.append(('error', u"{0}: no {1} entry in the "
+                             u"config".format(name, u" or ".join(missing))))
+            return None
+
+        graphdiff_path = self._config['graphdiff_path'] + graphdiffs[name]
+        mapping_path = self.mapping_path(name)
+        try:
+            graphdiff = GraphDiff(name, graphdiff_path)
+            mapping = Mapping(mapping_path, self._mapping_cache)
+            # as build_migrator makes it, so the matches are the ones the
+            # migration will make
+            converter = DataConverter(mapping, graphdiff, self._matcher)
+            table_path = self.fieldname_table_path(converter)
+            if table_path is not None and os.path.exists(table_path):
+                converter.load_fieldname_table(table_path)
+        except (IOError, KeyError, ValueError) as error:
+            problems.append(('error', u"{0}: {1}".format(name, error)))
+            return None
+        except BadZipfile as error:
+            problems.append(('error', u"{0}: {1}: {2}".format(
+                name, mapping_path, error)))
+            return None
+
+        datatypes = {}
+        fixable = DTFixer().datatypes
+        unfixable = set()
+        for v3_name, v4_name in sorted(graphdiff.data.items()):
+            match = converter.convert_v3_fieldname(v3_name)
+            datatype = datatypes[v3_name] = converter.get_datatype(match)
+
+            if v4_name not in mapping._node_datatypes:
+                severity, explanation = self.check_guess(datatype)
+                problems.append((severity, u"{0}: the graphdiff maps {1} "
+                                 u"to {2}, which isn't a node in {3}, so it "
+                                 u"will be fuzzy matched to {4}{5}".format(
+                                     name, v3_name, v4_name, mapping_path,
+                                     match, explanation)))
+                continue
+
+            if datatype not in fixable and datatype not in unfixable:
+                unfixable.add(datatype)
+                problems.append(('error', u"{0}: node {1} has datatype {2}, "
+                                 u"which there's no fixer for".format(
+                                     name, match, datatype)))
+        return converter, datatypes
+
+    def check_guess(self, datatype):
+        """(severity, explanation) for a v3 node fuzzy matched to a v4 node
+        of `datatype`: an error if its values couldn't be converted
+        """
+        if datatype is None:
+            return 'error', u", which isn't a node in the mapping either"
+        if datatype not in DTFixer().datatypes:
+            return 'error', u", whose datatype {0} there's no fixer " \
+                u"for".format(datatype)
+        return 'warning', u''
+
+    def preflight(self):
+        """Check the v3 export against the config, graphdiffs and mappings
+        without converting anything: every resource model and entitytypeid
+        in use has to be accounted for, and every date has to parse.
+        Returns all the problems found, as (severity, message) pairs;
+        errors would stop a migration part way through, warnings would let
+        it finish with output that needs checking.
+        """
+        problems = []
+        models = {}
+        unknown = {}
+        unparsed = {}
+
+        for name in self.models_to_use:
+            if name != "<all>" and name not in self._config['namediffs']:
+                problems.append(('error', u"{0} was asked for but isn't in "
+                                 u"the config".format(name)))
+
+        for r, offset in self.read_v3_resources():
+            name = r['entitytypeid']
+            if not self.use_model(name):
+                continue
+
+            if name not in models:
+                models[name] = self.check_model(name, problems)
+            if models[name] is None:
+                continue
+            converter, datatypes = models[name]
+
+            for field_name, value in iter_v3_nodes(r):
+                key = (name, field_name)
+                if key in unknown:
+                    unknown[key] += 1
+                elif field_name not in datatypes:
+                    # guessed the way the migration will guess it
+                    unknown[key] = 1
+                    datatypes[field_name] = converter.get_datatype(
+                        converter.convert_v3_fieldname(field_name))
+
+                if datatypes[field_name] == 'date' and value != '' and \
+                        parse_date(value) is None:
+                    add_counts(unparsed, {name: {field_name: {value: 1}}})
+
+        for (name, field_name), n in sorted(unknown.items()):
+            converter, datatypes = models[name]
+            match = converter.convert_v3_fieldname(field_name)
+            severity, explanation = self.check_guess(datatypes[field_name])
+            problems.append((severity, u"{0}: {1} ({2} nodes) isn't in the "
+                             u"graphdiff, so its v4 node will be guessed: "
+                             u"{3}{4}".format(name, field_name, n, match,
+                                             explanation)))
+
+        for name, nodes in sorted(unparsed.items()):
+            for field_name, values in sorted(nodes.items()):
+                problems.append(('warning', u"{0}: {1} date values of {2} in "
+                                 u"{3} different forms can't be parsed, "
+                                 u"e.g. {4}".format(
+                                     name, sum(values.values()), field_name,
+                                     len(values),
+                                     u", ".join(sorted(values)[:5]))))
+
+        return problems
+
+    def write_deleted(self):
+        """List the resources that were in the previous delta run but not
+        this one in deleted_resources.csv
+        """
+        namediffs = self._config['namediffs']
+        deleted = self._delta.deleted(self.use_model)
+
+        filename = os.path.join(self._output_dir, 'deleted_resources.csv')
+        with open(filename, 'wb') as csvfile:
+            writer = csv.writer(csvfile, encoding='utf-8')
+            writer.writerow([u"ResourceID", u"ResourceModel"])
+            for name, resource_id in deleted:
+                writer.writerow([resource_id, namediffs[name]])
+
+        counts = self._delta.counts
+        logger.info("delta: {0} new, {1} changed, {2} unchanged and {3} "
+                    "deleted resources".format(counts['new'],
+                                               counts['changed'],
+                                               counts['unchanged'],
+                                               len(deleted)))
+
+    def write_manifest(self):
+        """List every CSV shard, with its .mapping and how many resources,
+        rows and bytes it holds, in import_manifest.json, so the shards
+        can be imported into Arches 4 side by side.
+        """
+        shards = []
+        for v4_name, model_shards in sorted(self._output_shards.items()):
+            for shard in model_shards:
+                shard = dict(shard)
+                shard['resource_model'] = v4_name
+                shards.append(shard)
+
+        with open(self.manifest_path, 'w') as outfile:
+            json.dump({'shard_rows': self._shard_rows,
+                       'shard_size': self._shard_size,
+                       'shards': shards},
+                      outfile,
+                      indent=4,
+                      sort_keys=True)
+
+    def log_invalid_geometries(self):
+        for rm_name, migrator in sorted(self._resource_models.items()):
+            invalid = migrator.fixer.wkt.invalid
+            if not invalid['count']:
+                continue
+
+            logger.warning(
+                u"{0}: {1} geometries couldn't be normalized and were left "
+                u"as they were; {2} of them follow".format(
+                    rm_name, invalid['count'], len(invalid['sample'])))
+            for value, n in sorted(invalid['sample'].items()):
+                logger.debug(u"invalid geometry {0!r} x{1}".format(value, n))
+
+    def finish(self):
+        "save the fieldname tables and report what the run turned up"
+        self.save_fieldname_tables()
+        self.log_unresolved_nodes()
+        self.log_unparsed_dates()
+        self.log_invalid_geometries()
+        self.report_concepts()
+        self.report_fieldname_matches()
+        if self.shard_output:
+            self.write_manifest()
+
+    def spill_columns(self):
+        """Convert the export into the column store, leaving condensing the
+        nodes into rows and writing them out to write_columns.
+        """
+        remove_column_store(self._columns_dir)
+
+        writers = {}
+        try:
+            for migrator, resource in self.import_v3_resources():
+                writer = writers.get(migrator.name)
+                if writer is None:
+                    writer = ColumnWriter(self._columns_dir, migrator.name,
+                                          migrator.converter.v4_fieldnames)
+                    writers[migrator.name] = writer
+
+                writer.append(resource.resource_id,
+                              migrator.convert_v3_rows(resource.nodes))
+        except BaseException:
+            # a store cut short would otherwise pass for the whole model
+            for writer in writers.values():
+                writer.discard()
+            raise
+
+        for writer in writers.values():
+            writer.close()
+        write_column_store_manifest(self._columns_dir, writers)
+
+    def write_columns(self):
+        """Write the CSVs from the column store, which works without the
+        v3 export, so the output can be written again, with --gzip for
+        instance, without converting everything again.
+        """
+        for name in column_store_models(self._columns_dir):
+            if not self.use_model(name):
+                continue
+
+            migrator = self.get_migrator(name)
+            with self.open_writer(migrator) as writer:
+                for resource_id, v4_nodes in ColumnReader(self._columns_dir,
+                                                          name):
+                    self.write_rows(writer, migrator.get_v4_rows(
+                        v4_nodes, resource_id))
+
+        if self.shard_output:
+            self.write_manifest()
+
+    def migrator_reports(self, names):
+        "v3 model name -> migrator report, for each of `names`"
+        return {name: self.get_migrator(name).report() for name in names}
+
+    def remove_parts(self):
+        """Delete partial CSVs, finished or not, left in the output
+        directory by an earlier --workers run.
+        """
+        for filename in sorted(os.listdir(self._output_dir)):
+            if filename.endswith('.part') or filename.endswith('.part.tmp'):
+                logger.info("removing {0} from an earlier run".format(
+                    filename))
+                os.remove(os.path.join(self._output_dir, filename))
+
+    def migrate_parallel(self, workers, chunk_size=None, checkpoint=None):
+        """Fan resource models, and chunks of chunk_size resources within
+        them, out across a pool of worker processes. Each chunk is written
+        to a partial CSV and the parts are concatenated in file order
+        under a single header, so the output matches a serial run.
+
+        With a checkpoint, chunks it lists as written and models that have
+        already been merged are skipped, and the reports saved for them
+        are merged in again.
+        """
+        scanned = self.scan_v3_shards(workers)
+
+        merged = checkpoint.merged if checkpoint is not None else []
+        written = checkpoint.parts if checkpoint is not None else {}
+        tasks = []
+        parts = {}
+        tables = {}
+
+        # parts are merged shard by shard, each in file order
+        for (shard, name), (count, spans, skip) in sorted(scanned.items()):
+            if name in merged:
+                continue
+            # match the node names once here rather than in every part;
+            # the migrator isn't kept, as it would be pickled into every
+            # task along with this Migration
+            if name not in tables:
+                tables[name] = \
+                    self.build_migrator(name).converter.fieldname_table
+            table = tables[name]
+            size = chunk_size or count
+            parts.setdefault(name, [])
+            for start in range(0, count, size):
+                stop = min(start + size, count)
+                path = os.path.join(self._output_dir,
+                                    '{0}.{1:04d}.{2:09d}-{3:09d}.part'.format(
+                                        name, shard, start, start + size))
+                parts[name].append(path)
+                if os.path.basename(path) in written:
+                    continue
+                tasks.append((self, name, start, stop, path, shard,
+                              frozenset(i for i in skip
+                                        if start <= i < stop),
+                              spans[2 * start:2 * stop], table))
+
+        # start the biggest chunks first so one large model isn't left
+        # running on its own at the end
+        tasks.sort(key=lambda task: task[3] - task[2], reverse=True)
+
+        migrator_reports = {}
+        for name, migrator_report in written.values():
+            migrator_reports.setdefault(name, []).append(migrator_report)
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            for index, ((name, migrator_report), report) in enumerate(
+                    pool.imap(_migrate_part, tasks, chunksize=1)):
+                migrator_reports.setdefault(name, []).append(migrator_report)
+                if report is not None:
+                    instrumentation.merge(report)
+                if checkpoint is not None:
+                    checkpoint.add_part(os.path.basename(tasks[index][4]),
+                                        name, migrator_report)
+        finally:
+            pool.close()
+            pool.join()
+
+        for name in sorted(migrator_reports):
+            migrator = self.get_migrator(name)
+            for migrator_report in migrator_reports[name]:
+                migrator.merge_report(migrator_report)
+
+        for name in sorted(parts):
+            migrator = self.get_migrator(name)
+
+            with self.open_writer(migrator) as writer:
+                for path in parts[name]:
+                    with open(path, 'rb') as part:
+                        writer.copy_from(part)
+
+            for path in parts[name]:
+                os.remove(path)
+            if checkpoint is not None:
+                checkpoint.add_merged(name)
+
+        self.finish()
+
+    def migrate_pipeline(self, convert_workers=1, write_workers=1,
+                         queue_size=8, batch_size=100):
+        """Read, convert and write at the same time, rather than in turn.
+
+        A thread reads the export and hands it out in batches of
+        batch_size resources to convert_workers processes, which send the
+        rows back. The batches are put back in file order and each model's
+        rows go to one of write_workers writer threads, so the output is
+        the same as a serial run. The stages are joined by queues of
+        queue_size batches, and no more batches than will fit in them are
+        let out at once, so a slow stage holds the others back instead of
+        piling up in memory.
+        """
+        tasks = multiprocessing.Queue(queue_size)
+        results = multiprocessing.Queue(queue_size)
+        slots = threading.Semaphore(queue_size * 2 + convert_workers)
+        failed = []
+
+        # match the node names once here rather than in every converting
+        # process. Which models the export holds isn't known until it's
+        # read, so every model it could hold is matched; as in
+        # migrate_parallel, the migrators aren't kept
+        tables = {}
+        for name in sorted(self._config['namediffs']):
+            if self.use_model(name) and \
+               name in self._config['graphdiffs'] and \
+               os.path.exists(self.mapping_path(name)):
+                tables[name] = \
+                    self.build_migrator(name).converter.fieldname_table
+
+        converters = [multiprocessing.Process(
+            target=_pipeline_convert, args=(self, tables, tasks, results))
+            for i in range(convert_workers)]
+        for worker in converters:
+            worker.daemon = True
+            worker.start()
+
+        def read():
+            batch = []
+            seq = 0
+            try:
+                for r, offset in self.read_v3_resources():
+                    if not self.use_model(r['entitytypeid']):
+                        continue
+                    batch.append(r)
+                    if len(batch) == batch_size:
+                        slots.acquire()
+                        tasks.put((seq, batch))
+                        batch = []
+                        seq += 1
+                if batch:
+                    slots.acquire()
+                    tasks.put((seq, batch))
+            except Exception as e:
+                logger.exception("reading the v3 export failed")
+                failed.append(e)
+            for worker in converters:
+                tasks.put(None)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        writers = [PipelineWriter(self, queue_size)
+                   for i in range(write_workers)]
+        assigned = {}
+        pending = {}
+        next_seq = 0
+        finished = 0
+        succeeded = False
+
+        try:
+            while finished < convert_workers:
+                try:
+                    kind, payload = results.get(timeout=1)
+                except Queue.Empty:
+                    if any(worker.exitcode for worker in converters):
+                        raise RuntimeError("a converting process died")
+                    continue
 
-        for name, resources in v3_sorted.iteritems():
-            mapping_path = os.path.join(mappings_dir, namediffs[name] + ".zip")
+                if kind == 'error':
+                    raise RuntimeError(u"converting failed:\n" + payload)
 
-            graphdiff = GraphDiff(name, graphdiff_path +
-                                  graphdiffs[name])
-            mapping = Mapping(mapping_path)
-            converter = DataConverter(mapping, graphdiff)
+                if kind == 'done':
+                    migrator_reports, report = payload
+                    for name, migrator_report in migrator_reports.items():
+                        self.get_migrator(name).merge_report(migrator_report)
+                    if report is not None:
+                        instrumentation.merge(report)
+                    finished += 1
+                    continue
 
-            model = ResourceModelMigrator(name, converter)
+                seq, batch = payload
+                pending[seq] = batch
+                while next_seq in pending:
+                    for name, rows in pending.pop(next_seq):
+                        writer = assigned.get(name)
+                        if writer is None:
+                            writer = writers[len(assigned) % write_workers]
+                            assigned[name] = writer
+                        writer.put(self.get_migrator(name), rows)
+                    slots.release()
+                    next_seq += 1
+
+            if failed:
+                raise failed[0]
+            succeeded = True
+        finally:
+            for writer in writers:
+                writer.close()
+            if succeeded:
+                # every batch has been taken off the queue, so its feeder
+                # thread can be shut down cleanly
+                reader.join()
+                tasks.close()
+                tasks.join_thread()
+            else:
+                # the reader may have batches stuck in the queue that
+                # nothing will take; don't wait for them at exit
+                tasks.cancel_join_thread()
+            for worker in converters:
+                if not succeeded and worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+        for writer in writers:
+            if writer.error is not None:
+                raise writer.error
+
+        self.finish()
+
+    def migrate_data(self, process_model='<all>', workers=1,
+                     chunk_size=None, pipeline=False, write_workers=1,
+                     queue_size=8):
+        if pipeline and (self._checkpoint_every is not None or
+                         self._delta is not None or
+                         self._columns_dir is not None):
+            raise ValueError("the pipeline can't be combined with "
+                             "checkpoints, deltas or a column store")
+        if self._columns_dir is not None and \
+           (workers > 1 or self._checkpoint_every is not None or
+                self._delta is not None):
+            raise ValueError("a column store can't be combined with "
+                             "workers, checkpoints or deltas")
+
+        checkpoint = None
+        if self._checkpoint_every is not None:
+            if self._checkpoint_every < 1:
+                raise ValueError("checkpoints have to be at least one "
+                                 "resource apart")
+            if self.shard_output:
+                raise ValueError("checkpoints can't be used with sharded "
+                                 "CSV output")
+            if self.sharded:
+                raise ValueError("checkpoints only work with a single v3 "
+                                 "export file")
+            checkpoint = Checkpoint(self.checkpoint_path, self._v3_files[0],
+                                    self.models_to_use,
+                                    chunk_size if workers > 1 else None)
+            if checkpoint.complete:
+                logger.info("{0} says this migration has already finished; "
+                            "remove it to run again".format(
+                                self.checkpoint_path))
+                return
+            if not checkpoint.resumed:
+                # parts from another export or chunk size would otherwise
+                # be taken for finished chunks of this one
+                self.remove_parts()
+
+        if workers > 1 and self._delta is not None:
+            # hashes have to be compared in one place
+            logger.warning("delta migrations run in a single process")
+            workers = 1
+
+        if pipeline:
+            self.migrate_pipeline(workers, write_workers, queue_size)
+            return
+
+        if workers > 1:
+            self.migrate_parallel(workers, chunk_size, checkpoint)
+            if checkpoint is not None:
+                checkpoint.finish()
+            return
+
+        if self._columns_dir is not None:
+            self.spill_columns()
+            self.write_columns()
+            self.finish()
+            return
+
+        writers = {}
+        start = None
+
+        if checkpoint is not None and checkpoint.v3_offset is not None:
+            start = checkpoint.v3_offset
+            for name, model in sorted(checkpoint.models.items()):
+                migrator = self.get_migrator(name)
+                if name in checkpoint.reports:
+                    migrator.merge_report(checkpoint.reports[name])
+                writers[name] = self.open_writer(
+                    migrator, resume_at=model['csv_bytes'])
+                logger.info(u"resuming {0} after {1} resources, at {2}".format(
+                    migrator.v4_name, model['resources'], model['last_id']))
+
+        try:
+            for index, (migrator, resource) in enumerate(
+                    self.import_v3_resources(start)):
+                if self._delta is not None and \
+                   not self._delta.changed(migrator.name, resource):
+                    continue
 
-            for resource in resources:
-                model.add_resource(Resource(resource))
+                writer = writers.get(migrator.name)
+                if writer is None:
+                    writer = self.open_writer(migrator)
+                    writers[migrator.name] = writer
 
-            self._resource_models[model.v4_name] = model
+                self.write_rows(writer, migrator.migrate_resource(resource))
 
-    def migrate_data(self, process_model='<all>'):
-        for rm_name, migrator in self._resource_models.iteritems():
+                if checkpoint is not None:
+                    checkpoint.add_resource(migrator.name,
+                                            migrator.v4_name +
+                                            self._csv_suffix,
+                                            resource.resource_id)
+                    if (index + 1) % self._checkpoint_every == 0:
+                        checkpoint.update(self._v3_offset, writers,
+                                          self.migrator_reports(writers))
 
-            filename = os.path.join(self._output_dir, rm_name + '.csv')
-            migrator.converter.mapping.write(self._output_dir)
+            if checkpoint is not None:
+                checkpoint.update(self._v3_offset, writers,
+                                  self.migrator_reports(writers))
+                checkpoint.finish()
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        if self._delta is not None:
+            if self._delta.is_delta:
+                self.write_deleted()
+            self._delta.save(self.use_model)
+
+        self.finish()
+
+
+def _migrate_part(task):
+    # module-level so multiprocessing can pickle it
+    migration, args = task[0], task[1:]
+
+    if instrumentation is None:
+        return migration.migrate_part(*args), None
+
+    # forked workers start with a copy of the parent's numbers; only send
+    # back what this task adds
+    instrumentation.reset()
+    result = migration.migrate_part(*args)
+    return result, instrumentation.report()
 
-            with open(filename, 'wb') as csvfile:
-                fieldnames = migrator.converter.v4_fieldnames
-                writer = csv.DictWriter(csvfile,
-                                        fieldnames=fieldnames,
-                                        encoding='utf-8-sig')
-                writer.writeheader()
-                rows = migrator.migrate()
-                for row in rows:
-                    writer.writerow(row)
+
+def _count_v3_resources(task):
+    migration, args = task[0], task[1:]
+    return migration.count_v3_resources(*args)
+
+
+def _pipeline_convert(migration, tables, tasks, results):
+    """The conversion stage of Migration.migrate_pipeline, run in its own
+    process: turn each batch of v3 resources into (model, rows) pairs
+    until told to stop, then send back what the models' migrators turned
+    up. `tables` are the fieldname tables the parent resolved, taken on
+    by each model's migrator when it's first used.
+    """
+    try:
+        if instrumentation is not None:
+            instrumentation.reset()
+
+        for task in iter(tasks.get, None):
+            seq, batch = task
+            converted = []
+            for r in batch:
+                migrator = migration.get_migrator(r['entitytypeid'])
+                if migrator.name in tables:
+                    migrator.converter.merge_fieldname_table(
+                        tables.pop(migrator.name))
+                converted.append((migrator.name,
+                                  migrator.migrate_resource(Resource(r))))
+            results.put(('rows', (seq, converted)))
+
+        migrator_reports = dict(
+            (migrator.name, migrator.report())
+            for migrator in migration.resource_models.values())
+        results.put(('done', (migrator_reports, instrumentation.report()
+                              if instrumentation is not None else None)))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class PipelineWriter:
+    """A writer thread for Migration.migrate_pipeline. Rows put to it are
+    written, in the order they were put, to their model's CSV, which is
+    opened the first time the model turns up.
+    """
+
+    def __init__(self, migration, queue_size):
+        self._migration = migration
+        self._queue = Queue.Queue(queue_size)
+        self._writers = {}
+        self.error = None
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, migrator, rows):
+        if self.error is not None:
+            raise self.error
+        self._queue.put((migrator, rows))
+
+    def run(self):
+        try:
+            for migrator, rows in iter(self._queue.get, None):
+                writer = self._writers.get(migrator.name)
+                if writer is None:
+                    writer = self._migration.open_writer(migrator)
+                    self._writers[migrator.name] = writer
+                self._migration.write_rows(writer, rows)
+        except Exception as e:
+            logger.exception("writing the CSVs failed")
+            self.error = e
+            # keep taking rows so the stages before don't block
+            for item in iter(self._queue.get, None):
+                pass
+        finally:
+            for writer in self._writers.values():
+                writer.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class Instrumentation:
+    """Collects wall time and call counts per migration stage, and counters
+    per resource model. Nothing is measured until install() wraps the
+    methods involved, so a run without it pays nothing.
+
+    With --workers, each worker's numbers are added to the parent's, so
+    stage times are summed across processes while "migrate" is the
+    parent's wall time.
+    """
+
+    def __init__(self):
+        self._originals = []
+        self.reset()
+
+    def reset(self):
+        self._stages = {}
+        self._models = {}
+
+    def add_time(self, stage, seconds, calls=1):
+        totals = self._stages.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+        totals['calls'] += calls
+        totals['seconds'] += seconds
+
+    def count(self, model, counter, n=1):
+        counters = self._models.setdefault(model, {})
+        counters[counter] = counters.get(counter, 0) + n
+
+    def report(self):
+        return {'stages': self._stages, 'models': self._models}
+
+    def merge(self, report):
+        for stage, totals in report['stages'].items():
+            self.add_time(stage, totals['seconds'], totals['calls'])
+        for model, counters in report['models'].items():
+            for counter, n in counters.items():
+                self.count(model, counter, n)
+
+    def write(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.report(),
+                      outfile,
+                      indent=4,
+                      sort_keys=True)
+
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.time() - start)
+        return wrapper
+
+    def patch(self, owner, name, replacement):
+        if isinstance(owner, dict):
+            original = owner[name]
+            owner[name] = replacement
+        else:
+            original = owner.__dict__[name]
+            setattr(owner, name, replacement)
+        self._originals.append((owner, name, original))
+
+    def install(self):
+        stats = self
+
+        def iter_timed(*args, **kwargs):
+            reader = read(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    resource = next(reader)
+                except StopIteration:
+                    return
+                stats.add_time('load', time.time() - start)
+                yield resource
+        read = globals()['iter_v3_resources']
+        self.patch(globals(), 'iter_v3_resources', iter_timed)
+
+        def fix_datatype(fixer, datatype, *args):
+            start = time.time()
+            try:
+                return fix(fixer, datatype, *args)
+            finally:
+                seconds = time.time() - start
+                stats.add_time('datatypes', seconds)
+                stats.add_time('datatypes.' + datatype, seconds)
+        fix = DTFixer.__dict__['fix_datatype']
+        self.patch(DTFixer, 'fix_datatype', fix_datatype)
+
+        def convert_v3_fieldname(converter, field_name):
+            if field_name not in converter.fieldname_table:
+                stats.count(converter.resource_name, 'fieldname_guesses')
+            start = time.time()
+            try:
+                return convert(converter, field_name)
+            finally:
+                stats.add_time('fieldnames', time.time() - start)
+        convert = DataConverter.__dict__['convert_v3_fieldname']
+        self.patch(DataConverter, 'convert_v3_fieldname',
+                   convert_v3_fieldname)
+
+        def migrate_resource(migrator, resource):
+            rows = migrate(migrator, resource)
+            stats.count(migrator.v4_name, 'resources')
+            stats.count(migrator.v4_name, 'nodes', len(resource.nodes))
+            stats.count(migrator.v4_name, 'rows', len(rows))
+            return rows
+        migrate = ResourceModelMigrator.__dict__['migrate_resource']
+        self.patch(ResourceModelMigrator, 'migrate_resource',
+                   migrate_resource)
+
+        for owner, name, stage in [
+                (Mapping, '__init__', 'mapping'),
+                (DataConverter, 'build_fieldname_table', 'fieldname_table'),
+                (Resource, '__init__', 'flatten'),
+                (ResourceModelMigrator, 'convert_v3_rows', 'convert'),
+                (ResourceModelMigrator, 'get_v4_rows', 'condense'),
+                (Migration, 'write_rows', 'write'),
+                (Migration, 'migrate_data', 'migrate')]:
+            self.patch(owner, name, self.timed(stage, owner.__dict__[name]))
+
+    def uninstall(self):
+        while self._originals:
+            owner, name, original = self._originals.pop()
+            if isinstance(owner, dict):
+                owner[name] = original
+            else:
+                setattr(owner, name, original)
+
+
+# set from the command line with --stats
+instrumentation = None
+
+
+class ResourceTracer:
+    """Logs how the rows of chosen resources were built: every `sample`th
+    resource a process converts, or with resource_ids, only those. Each
+    trace is one JSON record on the graph_migrator.trace logger at debug
+    level, with the resource's v4 nodes and the rows they made.
+
+    Whether to trace is decided once per resource, and a record is only
+    formatted if a handler takes it, so the resources that aren't traced
+    cost nothing per node.
+    """
+
+    def __init__(self, sample=None, resource_ids=None):
+        self._sample = sample
+        self._resource_ids = frozenset(resource_ids) \
+            if resource_ids else None
+        self._seen = 0
+        self._logger = logging.getLogger('graph_migrator.trace')
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def wants(self, resource_id):
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return False
+        if self._resource_ids is not None:
+            return resource_id in self._resource_ids
+        if self._sample is None:
+            return False
+
+        self._seen += 1
+        return (self._seen - 1) % self._sample == 0
+
+    def trace(self, model, resource_id, v4_nodes, rows):
+        self._logger.debug(u"trace %s", TraceRecord(
+            model=model, resource_id=resource_id,
+            nodes=v4_nodes, rows=rows))
+
+
+class TraceRecord:
+    "a trace's fields, only turned into JSON when the record is written"
+
+    def __init__(self, **fields):
+        self._fields = fields
+
+    def __str__(self):
+        return json.dumps(self._fields, sort_keys=True)
+
+
+# set from the command line with --verbose, --trace-sample or
+# --trace-resource
+tracer = None
+
+
+def parse_size(size):
+    "a number of bytes, optionally with a K, M or G suffix"
+    match = re.match(r'^(\d+)([KMG]?)B?$', size.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "{0!r} isn't a size like 500M".format(size))
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+
+def positive_int(value):
+    "an int of at least 1, for argparse"
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "{0!r} isn't a whole number of 1 or more".format(value))
+    return number
 
 
 def get_logger(level='info'):
@@ -459,19 +3393,120 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("v3_data")
+    parser.add_argument("v3_data", nargs="?",
+                        help="The v3 export, or a directory or glob of "
+                        "export shards")
     parser.add_argument("-o", "--output",
                         help="The directory to output CSV and mapping files")
     parser.add_argument("-m", "--mappings",
                         help="The directory your .mapping zip files are in")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Turns on debug logging and prints to console")
+    parser.add_argument("--trace-sample", type=int, metavar="N",
+                        help="Logs how every Nth resource's rows were "
+                        "built (every 1000th with --verbose)")
+    parser.add_argument("--trace-resource", nargs="+", metavar="ID",
+                        help="Logs how these resources' rows were built, "
+                        "and no others")
     parser.add_argument("--process-model", nargs="+", default=["<all>"],
                         help="Allows you to pass the name of a single resource "
                         "model to process")
+    parser.add_argument("--fieldname-tables",
+                        help="A directory to load and save the resolved v3 to "
+                        "v4 node name tables in, so later runs skip fuzzy "
+                        "matching")
+    parser.add_argument("--mapping-cache",
+                        help="A directory to cache the parsed contents of the "
+                        "mapping zips in between runs")
+    parser.add_argument("--matcher", choices=sorted(MATCHERS),
+                        help="How to fuzzy match v3 node names to v4 ones "
+                        "(fuzzywuzzy by default)")
+    parser.add_argument("--wkt-precision", type=int, metavar="PLACES",
+                        help="Rounds geometry coordinates to this many "
+                        "decimal places")
+    parser.add_argument("--match-threshold", type=int, metavar="SCORE",
+                        help="Reports node name matches scoring under SCORE "
+                        "(out of 100) in low_confidence_fieldnames.json")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="The number of processes to migrate resource "
+                        "models with")
+    parser.add_argument("--chunk-size", type=int,
+                        help="With --workers, split resource models into "
+                        "chunks of this many resources")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Reads, converts (in --workers processes) and "
+                        "writes at the same time")
+    parser.add_argument("--write-workers", type=int, default=1,
+                        help="With --pipeline, the number of threads to "
+                        "write CSVs with")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="With --pipeline, how many batches of resources "
+                        "each stage can queue up for the next")
+    parser.add_argument("--checkpoint", type=positive_int, nargs="?",
+                        const=1000,
+                        metavar="N",
+                        help="Saves progress every N resources (1000 by "
+                        "default) so a rerun after a crash picks up where "
+                        "this one stopped")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Writes gzipped CSVs (<model>.csv.gz)")
+    parser.add_argument("--shard-rows", type=int, metavar="N",
+                        help="Splits each model's CSV into shards of at "
+                        "most N rows, listed in import_manifest.json")
+    parser.add_argument("--shard-size", type=parse_size, metavar="SIZE",
+                        help="Splits each model's CSV into shards of at "
+                        "most SIZE bytes (e.g. 500M), listed in "
+                        "import_manifest.json")
+    parser.add_argument("--delta", metavar="STATE_FILE",
+                        help="Keeps a hash of every resource in STATE_FILE. "
+                        "When it already exists, only new and changed "
+                        "resources are written, to <model>.delta.csv, and "
+                        "removed ones are listed in deleted_resources.csv")
+    parser.add_argument("--columns", metavar="DIR",
+                        help="Spills the converted nodes to a column store "
+                        "in DIR and writes the CSVs from there")
+    parser.add_argument("--output-only", action="store_true",
+                        help="With --columns, skips the v3 export and only "
+                        "writes the CSVs again from the column store")
+    parser.add_argument("--preflight", action="store_true",
+                        help="Checks the export against the config, "
+                        "graphdiffs and mappings, prints every problem found "
+                        "and exits without converting anything")
+    parser.add_argument("--stats", action="store_true",
+                        help="Writes per-stage timings and per-model counts "
+                        "to logs/business_data_conversion_stats.json")
+    parser.add_argument("--profile", action="store_true",
+                        help="Runs the migration under cProfile and dumps "
+                        "the stats to logs/business_data_conversion.prof")
 
     args = parser.parse_args()
 
+    if args.delta and args.checkpoint is not None:
+        parser.error("--delta can't be combined with --checkpoint")
+    if args.gzip and args.checkpoint is not None:
+        parser.error("--gzip can't be combined with --checkpoint")
+    if (args.shard_rows or args.shard_size) and \
+       args.checkpoint is not None:
+        parser.error("--shard-rows and --shard-size can't be combined with "
+                     "--checkpoint")
+    if args.output_only and not args.columns:
+        parser.error("--output-only needs --columns")
+    if args.v3_data is None and not args.output_only:
+        parser.error("v3_data is needed unless writing with --output-only")
+    if args.checkpoint is not None and args.v3_data and \
+       len(v3_shards(args.v3_data)) > 1:
+        parser.error("--checkpoint only works with a single v3 export file")
+    if args.columns and (args.checkpoint is not None or args.delta or
+                         args.workers > 1):
+        parser.error("--columns can't be combined with --checkpoint, "
+                     "--delta or --workers")
+    if args.pipeline and (args.checkpoint is not None or args.delta or
+                          args.columns):
+        parser.error("--pipeline can't be combined with --checkpoint, "
+                     "--delta or --columns")
+    if args.matcher == 'rapidfuzz' and rapid_process is None:
+        parser.error("--matcher rapidfuzz needs rapidfuzz installed")
+
     if args.verbose:
         lvl = "debug"
     else:
@@ -479,6 +3514,58 @@ if __name__ == "__main__":
 
     logger = get_logger(lvl)
 
-    migrator = Migration(args.v3_data, args.mappings, args.output, args.process_model)
+    if args.trace_sample or args.trace_resource or args.verbose:
+        tracer = ResourceTracer(args.trace_sample or 1000,
+                                args.trace_resource)
+        tracer.logger.setLevel(logging.DEBUG)
+
+    migrator = Migration(args.v3_data, args.mappings, args.output,
+                         args.process_model,
+                         fieldname_tables=args.fieldname_tables,
+                         checkpoint_every=args.checkpoint,
+                         delta_state=args.delta,
+                         mapping_cache=args.mapping_cache,
+                         gzip_output=args.gzip,
+                         matcher=args.matcher,
+                         match_threshold=args.match_threshold,
+                         columns_dir=args.columns,
+                         shard_rows=args.shard_rows,
+                         shard_size=args.shard_size,
+                         wkt_precision=args.wkt_precision)
+
+    if args.preflight:
+        problems = migrator.preflight()
+        for severity, message in problems:
+            getattr(logger, severity)(message)
+            print(u"{0}: {1}".format(severity.upper(), message)
+                  .encode('utf-8'))
+        errors = len([p for p in problems if p[0] == 'error'])
+        print("{0} errors, {1} warnings".format(errors,
+                                                len(problems) - errors))
+        raise SystemExit(1 if errors else 0)
+
+    if args.stats:
+        instrumentation = Instrumentation()
+        instrumentation.install()
+
+    if args.output_only:
+        run, run_args = migrator.write_columns, {}
+    else:
+        run, run_args = migrator.migrate_data, {
+            'workers': args.workers,
+            'chunk_size': args.chunk_size,
+            'pipeline': args.pipeline,
+            'write_workers': args.write_workers,
+            'queue_size': args.queue_size}
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run, **run_args)
+        profiler.dump_stats(os.path.join('logs',
+                                         'business_data_conversion.prof'))
+    else:
+        run(**run_args)
 
-    migrator.migrate_data()
+    if instrumentation is not None:
+        instrumentation.write(os.path.join(
+            'logs', 'business_data_conversion_stats.json'))
@@ -1,164 +1,449 @@
-"""
-This utility converts an Arches 3 SKOS-formatted scheme file into
-an Arches 4 thesaurus file and collections file for import
-"""
-
-from lxml import etree
-from rdflib import Graph
-import os
-import json
-import uuid
-import argparse
-
-
-parser = argparse.ArgumentParser()
-
-parser.add_argument("skosfile",
-                    help="The Arches V3 Scheme you've exported from the Reference Data Manager")
-
-parser.add_argument("-u", "--uri",
-                    nargs="?",
-                    default="http://www.archesproject.org/",
-                    help="(Recommended) The root URI of your Arches installation's RDM (https://www.example.com/rdm/)"
-                    )
-parser.add_argument("-d", "--directory",
-                    nargs="?",
-                    default="Arches",
-                    help="The name of the directory to save data files in")
-
-
-args = parser.parse_args()
-
-
-def update_arches_namespace(xml_str):
-    "substitute www.archesproject.org with the installation domain"
-    return xml_str.replace("http://www.archesproject.org/", args.uri)
-
-
-def prepare_export(namespaces, nodes):
-    """
-    return a graph with the desired node type for writing out to XML,
-    with cleaned-up namespaces
-    """
-
-    output_graph = Graph()
-    [output_graph.bind(k, v) for k, v in namespaces.items()]
-
-    [output_graph.parse(
-        data=etree.tostring(node),
-        nsmap=namespaces)
-     for node in nodes]
-
-    return output_graph
-
-
-def export(filename, content):
-    directory = args.directory
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    with open(directory + '/' + filename, 'w') as fh:
-        fh.write(content)
-        fh.close
-
-
-with open(args.skosfile, 'r') as incoming_skos:
-
-    uuid_file = 'collection_uuids.json'
-
-    with open(uuid_file, 'r') as uuid_store:
-        uuids = json.load(uuid_store)
-
-    def new_or_existing_uuid(preflabel):
-        """
-        otake a topConcept's prefLabel node, parse the JSON within, and
-        return a new or existing UUID for the collection based on
-        whether we already have one for the JSON's `value` key
-
-        """
-        preflabel_val = json.loads(preflabel.text)['value']
-
-        if preflabel_val in uuids:
-            return uuids[preflabel_val]
-        else:
-            new_uuid = str(uuid.uuid4())
-            uuids[preflabel_val] = new_uuid
-            return new_uuid
-
-    def new_preflabel_uuid(preflabel):
-        """
-        Concept Values in Arches have a UUID (stored in the embedded JSON)
-        and a 1-1 mapping with their Concept; if a Collection shares a
-        prefLabel with a Concept, it needs a new ID to avoid
-        clobbering the same attribute on the existing Concept
-        """
-        working = json.loads(preflabel.text)
-        working['id'] = unicode(uuid.uuid4())
-        preflabel.text = json.dumps(working)
-
-    fixed_ns_raw = update_arches_namespace(incoming_skos.read())
-    skos_xml = etree.fromstring(fixed_ns_raw)
-    namespaces = skos_xml.nsmap
-
-    # retrieve concepts and collections from skos with regular ol' xpath
-    concepts = skos_xml.xpath("./skos:Concept", namespaces=namespaces)
-    collections = skos_xml.xpath("./skos:Collection", namespaces=namespaces)
-    top_concepts = skos_xml.xpath(".//skos:hasTopConcept", namespaces=namespaces)
-
-    top_concept_uris = [
-        concept.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource")
-        for concept in top_concepts]
-
-    for concept in concepts:
-        uri = concept.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about")
-        if uri in top_concept_uris:
-            # create a new top level Collection based on the topConcept
-            collection = etree.Element(
-                "{http://www.w3.org/2004/02/skos/core#}Collection",
-                nsmap=namespaces)
-
-            # migrate nested concepts and attributes into new
-            # Collection
-            #################################################
-
-            # hacky-deepcopy the TopConcept to avoid mutating original
-            # (still needed for thesaurus export)
-            working_concept = etree.fromstring(etree.tostring(concept))
-
-            # give the collection a UUID based on the prefLabel
-            col_preflabel = working_concept.find('./skos:prefLabel',
-                                                 namespaces=namespaces)
-
-            new_preflabel_uuid(col_preflabel)
-
-            col_uuid = new_or_existing_uuid(col_preflabel)
-            fq_uuid = namespaces['arches'] + col_uuid
-            collection.set("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about",
-                           fq_uuid)
-
-            # change skos:narrower into valid skos:member tags in the
-            # Concept's first-level children
-            for narrower in working_concept.xpath("skos:narrower",
-                                                  namespaces=namespaces):
-                narrower.tag = "{http://www.w3.org/2004/02/skos/core#}member"
-
-            # Append the child concepts to the new Collection
-            [collection.append(child) for child in
-             working_concept.getchildren()]
-
-            collections.append(collection)
-
-    # prepare raw XML
-    thesaurus_skos = prepare_export(namespaces,
-                                    concepts).serialize(format='pretty-xml')
-    collections_skos = prepare_export(namespaces,
-                                      collections).serialize(format='pretty-xml')
-
-    # export files
-    export('thesaurus.xml', thesaurus_skos)
-    export('collections.xml', collections_skos)
-
-    # write UUID's
-    with open(uuid_file, 'w') as uuid_store:
-        uuid_store.write(json.dumps(uuids, indent=4, sort_keys=True))
-        uuid_store.close()
+"""
+This utility converts an Arches 3 SKOS-formatted scheme file into
+an Arches 4 thesaurus file and collections file for import
+"""
+
+from lxml import etree
+from multiprocessing.pool import ThreadPool
+import copy
+import os
+import json
+import uuid
+import argparse
+
+from xml.sax.saxutils import escape
+
+try:
+    from rdflib import Graph
+except ImportError:
+    # only needed for --validate
+    Graph = None
+
+ARCHES_URI = "http://www.archesproject.org/"
+
+RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+SKOS = "{http://www.w3.org/2004/02/skos/core#}"
+
+
+def update_arches_namespace(xml_str, uri):
+    "substitute www.archesproject.org with the installation domain"
+    return xml_str.replace(ARCHES_URI, uri)
+
+
+class NamespaceRewriter:
+    """
+    A file-like wrapper for iterparse that applies update_arches_namespace
+    to the scheme as it's read. The end of each chunk is held back if it
+    could be the start of a URI that carries on into the next one.
+    """
+
+    def __init__(self, fileobj, uri):
+        self._file = fileobj
+        self._uri = uri
+        self._held = ''
+
+    def read(self, size=1 << 16):
+        while True:
+            chunk = self._file.read(size)
+            if not chunk:
+                data, self._held = self._held, ''
+                return data
+
+            data = self._held + chunk
+            held = 0
+            for length in range(len(ARCHES_URI) - 1, 0, -1):
+                if data.endswith(ARCHES_URI[:length]):
+                    held = length
+                    break
+
+            self._held = data[len(data) - held:]
+            if held < len(data):
+                # an empty string would read as the end of the file
+                return update_arches_namespace(data[:len(data) - held],
+                                               self._uri)
+
+
+def prepare_export(namespaces, nodes):
+    """
+    return an rdf:RDF document holding the nodes, written straight from
+    the lxml elements, with the namespaces declared once at the top
+    """
+    rdf = etree.Element(RDF + "RDF", nsmap=namespaces)
+    rdf.text = "\n  "
+    for node in nodes:
+        node.tail = "\n  "
+        rdf.append(node)
+    if len(rdf):
+        rdf[-1].tail = "\n"
+
+    # drop the declarations the nodes brought with them from the scheme
+    etree.cleanup_namespaces(rdf)
+
+    return etree.tostring(rdf, xml_declaration=True, encoding='utf-8')
+
+
+def validate(path):
+    "parse an exported file with rdflib, and return the number of triples"
+    graph = Graph()
+    graph.parse(path, format='xml')
+    return len(graph)
+
+
+def export_path(directory, filename):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    return directory + '/' + filename
+
+
+def export(directory, filename, content):
+    with open(export_path(directory, filename), 'wb') as fh:
+        fh.write(content)
+        fh.close
+
+
+def new_or_existing_uuid(preflabel, uuids):
+    """
+    otake a topConcept's prefLabel node, parse the JSON within, and
+    return a new or existing UUID for the collection based on
+    whether we already have one in `uuids` for the JSON's `value` key
+
+    """
+    preflabel_val = json.loads(preflabel.text)['value']
+
+    if preflabel_val in uuids:
+        return uuids[preflabel_val]
+    else:
+        # setdefault so that schemes being converted at the same time
+        # agree on the UUID of a collection they both have
+        return uuids.setdefault(preflabel_val, str(uuid.uuid4()))
+
+
+def new_preflabel_uuid(preflabel):
+    """
+    Concept Values in Arches have a UUID (stored in the embedded JSON)
+    and a 1-1 mapping with their Concept; if a Collection shares a
+    prefLabel with a Concept, it needs a new ID to avoid
+    clobbering the same attribute on the existing Concept
+    """
+    working = json.loads(preflabel.text)
+    working['id'] = unicode(uuid.uuid4())
+    preflabel.text = json.dumps(working)
+
+
+def concept_to_collection(concept, namespaces, uuids, copy_children=True):
+    """
+    create a new top level Collection based on a topConcept. The
+    concept's children are copied into it one by one, leaving the
+    concept as it was for the thesaurus export, or moved if
+    copy_children is False
+    """
+    collection = etree.Element(SKOS + "Collection", nsmap=namespaces)
+    collection.text = concept.text
+
+    # change skos:narrower into valid skos:member tags in the
+    # Concept's first-level children as they go into the new
+    # Collection
+    for child in list(concept):
+        if copy_children:
+            child = copy.deepcopy(child)
+        if child.tag == SKOS + "narrower":
+            child.tag = SKOS + "member"
+        collection.append(child)
+
+    # give the collection a UUID based on the prefLabel
+    col_preflabel = collection.find(SKOS + "prefLabel")
+
+    new_preflabel_uuid(col_preflabel)
+
+    col_uuid = new_or_existing_uuid(col_preflabel, uuids)
+    fq_uuid = namespaces['arches'] + col_uuid
+    collection.set(RDF + "about", fq_uuid)
+
+    return collection
+
+
+def top_concept_index(skos_xml):
+    "the URIs of every topConcept in the scheme, as a set"
+    return set(top_concept.get(RDF + "resource")
+               for top_concept in skos_xml.iter(SKOS + "hasTopConcept"))
+
+
+def build_collections(concepts, top_concept_uris, namespaces, uuids):
+    """
+    Make a Collection of every concept whose URI is in the
+    top_concept_uris set, in a single pass over the concepts. The
+    concepts themselves are left as they were; collection UUIDs come
+    from, and new ones are added to, `uuids` (prefLabel -> UUID)
+    """
+    return [concept_to_collection(concept, namespaces, uuids)
+            for concept in concepts
+            if concept.get(RDF + "about") in top_concept_uris]
+
+
+def namespace_declaration(prefix, uri):
+    "the xmlns attribute lxml writes for a prefix (None for the default)"
+    return ' xmlns{0}="{1}"'.format(
+        '' if prefix is None else ':' + prefix,
+        escape(uri, {'"': '&quot;'}))
+
+
+def serialize_child(element, namespaces):
+    """
+    Serialize a child of rdf:RDF as UTF-8 without the declarations of
+    `namespaces` that lxml copies onto it from its parent, so that it
+    relies on the ones made by the root of the file it's written to
+    """
+    xml = etree.tostring(element, encoding='utf-8', xml_declaration=False)
+    end = xml.index('>')
+    start_tag = xml[:end]
+    for prefix, uri in namespaces.items():
+        start_tag = start_tag.replace(
+            namespace_declaration(prefix, uri).encode('utf-8'), b'', 1)
+    return start_tag + xml[end:]
+
+
+def find_top_concepts(skosfile, uri):
+    "first pass of --stream: the URIs of the scheme's topConcepts"
+    top_concept_uris = set()
+
+    with open(skosfile, 'rb') as incoming_skos:
+        for event, element in etree.iterparse(
+                NamespaceRewriter(incoming_skos, uri)):
+            if element.tag == SKOS + "hasTopConcept":
+                top_concept_uris.add(element.get(RDF + "resource"))
+            elif element.getparent() is not None and \
+                    element.getparent().getparent() is None:
+                # done with this child of rdf:RDF and everything in it
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    return top_concept_uris
+
+
+def stream_export(skosfile, uri, directory, uuids):
+    """
+    Convert the scheme one top level element at a time, writing each
+    Concept to the thesaurus and each Collection, old or new, to the
+    collections file as soon as it's been read. Only the root elements
+    go through xmlfile; the rest are written straight to the files, as
+    xmlfile would declare every namespace again on each of them.
+    """
+    top_concept_uris = find_top_concepts(skosfile, uri)
+
+    with open(skosfile, 'rb') as incoming_skos, \
+            open(export_path(directory, 'thesaurus.xml'),
+                 'wb') as thesaurus_out, \
+            open(export_path(directory, 'collections.xml'),
+                 'wb') as collections_out:
+
+        context = etree.iterparse(NamespaceRewriter(incoming_skos, uri),
+                                  events=('start', 'end'))
+        event, root = next(context)
+        namespaces = root.nsmap
+
+        with etree.xmlfile(thesaurus_out, encoding='utf-8') as thesaurus, \
+                etree.xmlfile(collections_out,
+                              encoding='utf-8') as collections:
+            thesaurus.write_declaration()
+            collections.write_declaration()
+
+            with thesaurus.element(root.tag, nsmap=namespaces), \
+                    collections.element(root.tag, nsmap=namespaces):
+                for event, element in context:
+                    if event != 'end' or element.getparent() is not root:
+                        continue
+
+                    if element.tag == SKOS + "Concept":
+                        thesaurus.flush()
+                        thesaurus_out.write(
+                            serialize_child(element, namespaces))
+                        if element.get(RDF + "about") in top_concept_uris:
+                            # the concept's been written out, so its
+                            # children can be moved without a copy
+                            collection = concept_to_collection(
+                                element, namespaces, uuids,
+                                copy_children=False)
+                            collections.flush()
+                            collections_out.write(
+                                serialize_child(collection, namespaces) +
+                                b"\n")
+                    elif element.tag == SKOS + "Collection":
+                        collections.flush()
+                        collections_out.write(
+                            serialize_child(element, namespaces))
+
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del root[0]
+
+
+def export_all(skosfile, uri, directory, uuids):
+    """
+    Convert the scheme with the whole of it in memory
+    """
+    with open(skosfile, 'r') as incoming_skos:
+
+        fixed_ns_raw = update_arches_namespace(incoming_skos.read(), uri)
+        skos_xml = etree.fromstring(fixed_ns_raw)
+        namespaces = skos_xml.nsmap
+
+        # retrieve concepts and collections from skos
+        concepts = list(skos_xml.iterchildren(SKOS + "Concept"))
+        collections = list(skos_xml.iterchildren(SKOS + "Collection"))
+
+        collections += build_collections(concepts,
+                                         top_concept_index(skos_xml),
+                                         namespaces, uuids)
+
+        # prepare raw XML
+        thesaurus_skos = prepare_export(namespaces, concepts)
+        collections_skos = prepare_export(namespaces, collections)
+
+        # export files
+        export(directory, 'thesaurus.xml', thesaurus_skos)
+        export(directory, 'collections.xml', collections_skos)
+
+
+class UUIDStore:
+    """
+    The UUIDs given to collections, by prefLabel, kept in a JSON file so
+    that a collection keeps its UUID from one conversion to the next
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._uuids = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as uuid_store:
+                self._uuids = json.load(uuid_store)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def uuids(self):
+        "prefLabel -> UUID"
+        return self._uuids
+
+    def save(self):
+        # write and rename so a crash never leaves half a store
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as uuid_store:
+            uuid_store.write(json.dumps(self._uuids, indent=4,
+                                        sort_keys=True))
+        os.rename(tmp_path, self._path)
+
+
+class SkosConverter:
+    """
+    Converts Arches 3 schemes to Arches 4 thesaurus and collections
+    files, any number of them in one go, giving collections their UUIDs
+    from `store`, a UUIDStore. The store is only written by save, so save
+    once the conversions are done.
+    """
+
+    def __init__(self, uri, store, stream=False):
+        self._uri = uri
+        self._store = store
+        self._stream = stream
+
+    @property
+    def store(self):
+        return self._store
+
+    def convert(self, skosfile, directory):
+        "convert one scheme, writing its files to `directory`"
+        if self._stream:
+            stream_export(skosfile, self._uri, directory, self._store.uuids)
+        else:
+            export_all(skosfile, self._uri, directory, self._store.uuids)
+        return directory
+
+    def convert_dir(self, scheme_dir, directory, workers=1):
+        """
+        convert every .xml scheme in `scheme_dir`, `workers` at a time,
+        each to a directory of its own name in `directory`. Threads
+        rather than processes, so every scheme sees the same UUIDs;
+        lxml lets go of the GIL while it parses and serializes.
+        returns the output directories
+        """
+        tasks = [(os.path.join(scheme_dir, filename),
+                  os.path.join(directory, os.path.splitext(filename)[0]))
+                 for filename in sorted(os.listdir(scheme_dir))
+                 if filename.endswith('.xml')]
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(lambda task: self.convert(*task), tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def save(self):
+        self._store.save()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("skosfile",
+                        help="The Arches V3 Scheme you've exported from the Reference Data Manager, or a directory of them")
+
+    parser.add_argument("-u", "--uri",
+                        nargs="?",
+                        default=ARCHES_URI,
+                        help="(Recommended) The root URI of your Arches installation's RDM (https://www.example.com/rdm/)"
+                        )
+    parser.add_argument("-d", "--directory",
+                        nargs="?",
+                        default="Arches",
+                        help="The name of the directory to save data files in")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="Read the scheme one element at a time and write "
+                        "the output as it goes, for thesauri too large to "
+                        "load into memory at once")
+    parser.add_argument("--validate",
+                        action="store_true",
+                        help="Parse the thesaurus and collections files with "
+                        "rdflib once they're written, to check they're valid "
+                        "RDF/XML")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="With a directory of schemes, how many to "
+                        "convert at once")
+
+    args = parser.parse_args()
+
+    if args.validate and Graph is None:
+        parser.error("--validate needs rdflib installed")
+
+    converter = SkosConverter(args.uri, UUIDStore('collection_uuids.json'),
+                              stream=args.stream)
+
+    if os.path.isdir(args.skosfile):
+        directories = converter.convert_dir(args.skosfile, args.directory,
+                                            args.workers)
+    else:
+        directories = [converter.convert(args.skosfile, args.directory)]
+
+    if args.validate:
+        for directory in directories:
+            for filename in ['thesaurus.xml', 'collections.xml']:
+                path = export_path(directory, filename)
+                print("{0}: {1} triples".format(path, validate(path)))
+
+    # write UUID's
+    converter.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+Checks that ColumnWriter output reads back the same through ColumnReader,
+and that a spill which didn't finish, or one from an earlier run, isn't
+taken for a finished store.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import ColumnReader, ColumnWriter, column_store_models, \
+    remove_column_store, write_column_store_manifest
+
+FIELDNAMES = [u"ResourceID", u"Name", u"Height", u"Note"]
+
+RESOURCES = [
+    (u"r1", [(u"Name", u"Römer bridge"), (u"Height", 12.5)]),
+    (u"r2", []),
+    (u"r3", [(u"Note", None), (u"Name", u"mill"), (u"Height", 3)]),
+]
+
+
+class ColumnStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='column_store_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def spill(self, name, resources):
+        writer = ColumnWriter(self.directory, name, FIELDNAMES, batch_size=2)
+        for resource_id, v4_nodes in resources:
+            writer.append(resource_id, v4_nodes)
+        writer.close()
+
+    def test_round_trip(self):
+        self.spill('Bridge', RESOURCES)
+        write_column_store_manifest(self.directory, ['Bridge'])
+
+        self.assertEqual(column_store_models(self.directory), ['Bridge'])
+        self.assertEqual(list(ColumnReader(self.directory, 'Bridge')),
+                         [(u"r1", [(u"Name", u"Römer bridge"),
+                                   (u"Height", '12.5')]),
+                          (u"r2", []),
+                          (u"r3", [(u"Note", None), (u"Name", u"mill"),
+                                   (u"Height", '3')])])
+
+    def test_discarded_spill_is_refused(self):
+        writer = ColumnWriter(self.directory, 'Bridge', FIELDNAMES)
+        writer.append(*RESOURCES[0])
+        writer.discard()
+
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertRaises(ValueError, ColumnReader, self.directory, 'Bridge')
+        self.assertRaises(ValueError, column_store_models, self.directory)
+
+    def test_no_manifest_is_refused(self):
+        # every model closed, but the spill never got as far as saying so
+        self.spill('Bridge', RESOURCES)
+        self.assertRaises(ValueError, column_store_models, self.directory)
+
+    def test_earlier_store_is_removed(self):
+        self.spill('Bridge', RESOURCES)
+        self.spill('Mill', RESOURCES[1:])
+        write_column_store_manifest(self.directory, ['Bridge', 'Mill'])
+        with open(os.path.join(self.directory, 'notes.txt'), 'w') as outfile:
+            outfile.write('kept')
+
+        remove_column_store(self.directory)
+        self.spill('Mill', RESOURCES[:1])
+        write_column_store_manifest(self.directory, ['Mill'])
+
+        self.assertEqual(column_store_models(self.directory), ['Mill'])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['Mill.columns', 'Mill.columns.json', 'Mill.ends',
+                          'Mill.starts', 'Mill.types', 'Mill.values',
+                          'column_store.json', 'notes.txt'])
+        self.assertEqual([resource_id for resource_id, v4_nodes in
+                          ColumnReader(self.directory, 'Mill')], [u"r1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# coding: utf-8
+"""
+Checks how v3 node names that aren't in the graphdiff are converted: they
+are guessed from the mapping's nodes, never the ResourceID column, and a
+node matched to something the migrator has no fixer for is left out and
+reported rather than stopping the run.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import DataConverter, GraphDiff, Mapping, \
+    ResourceModelMigrator
+
+NODES = [
+    (u"Name", u"string"),
+    (u"Description", u"string"),
+    (u"Place Description", u"string"),
+    (u"Location", u"semantic"),
+]
+
+GRAPHDIFF = {
+    u"NAME.E41": u"Name",
+    u"DESCRIPTION.E62": u"Description",
+}
+
+
+class DataConverterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='data_converter_test')
+
+        path = os.path.join(self.directory, 'Place.zip')
+        with ZipFile(path, 'w') as mzip:
+            mzip.writestr('Place.mapping', json.dumps({
+                'resource_model_name': 'Place',
+                'nodes': [{'arches_node_name': name, 'data_type': datatype}
+                          for name, datatype in NODES]}))
+            mzip.writestr('Place_concepts.json', json.dumps({}))
+
+        graphdiff_path = os.path.join(self.directory, 'place.json')
+        with open(graphdiff_path, 'w') as outfile:
+            json.dump(GRAPHDIFF, outfile)
+
+        self.migrator = ResourceModelMigrator(
+            'PLACE.E53', DataConverter(Mapping(path),
+                                       GraphDiff('PLACE.E53',
+                                                 graphdiff_path)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unmapped_name_never_matches_resourceid(self):
+        converter = self.migrator.converter
+        for v3_name in [u"RESOURCE_ID.E42", u"ID.E42"]:
+            v4_name = converter.convert_v3_fieldname(v3_name)
+            self.assertNotEqual(v4_name, u"ResourceID")
+            self.assertIn(v4_name, [name for name, datatype in NODES])
+
+    def test_unmapped_name_is_converted(self):
+        v4_nodes = self.migrator.convert_v3_rows([
+            (u"NAME.E41", u"Stone Bridge"),
+            (u"RESOURCE_ID.E42", u"R-0001"),
+            (u"PLACE_DESCRIPTION.E62", u"by the river"),
+        ])
+        self.assertEqual(v4_nodes[0], (u"Name", u"Stone Bridge"))
+        self.assertIn((u"Place Description", u"by the river"), v4_nodes)
+        self.assertNotIn(u"ResourceID", [name for name, value in v4_nodes])
+
+    def test_node_without_a_fixer_is_left_out(self):
+        v4_nodes = self.migrator.convert_v3_rows([
+            (u"NAME.E41", u"Stone Bridge"),
+            (u"LOCATION.E53", u"somewhere"),
+            (u"LOCATION.E53", u"elsewhere"),
+        ])
+        self.assertEqual(v4_nodes, [(u"Name", u"Stone Bridge")])
+        self.assertEqual(self.migrator.unresolved_nodes,
+                         {u"LOCATION.E53": {u"Location": 2}})
+
+        # and comes back with a worker's report
+        other = ResourceModelMigrator('PLACE.E53', self.migrator.converter)
+        other.merge_report(self.migrator.report())
+        self.assertEqual(other.unresolved_nodes,
+                         {u"LOCATION.E53": {u"Location": 2}})
+
+
+if __name__ == '__main__':
+    unittest.main()
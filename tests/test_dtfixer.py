@@ -0,0 +1,81 @@
+# coding: utf-8
+"""
+Checks DTFixer's date handling: the formats it parses, and that the dates
+it can't parse are counted without the record of them, or the memo of
+dates seen, growing with the export.
+"""
+
+from datetime import date, timedelta
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import DTFixer
+
+
+class FixDateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixer = DTFixer()
+
+    def fix(self, value):
+        return self.fixer.fix_datatype('date', value)
+
+    def test_formats(self):
+        self.assertEqual(self.fix(u"1999-02-01T00:00:00"), u"1999-02-01")
+        self.assertEqual(self.fix(u" 1999-02-01 "), u"1999-02-01")
+        self.assertEqual(self.fix(u"1999/02/01"), u"1999-02-01")
+        self.assertEqual(self.fix(u"1 February 1999"), u"1999-02-01")
+        self.assertEqual(self.fix(u""), u"")
+
+    def test_unparsed_are_left_and_counted(self):
+        # day and month first can't be told apart, so neither is guessed
+        for value in [u"01/02/1999", u"sometime", u"01/02/1999"]:
+            self.assertEqual(self.fix(value), value)
+
+        self.assertEqual(self.fixer.unparsed_dates,
+                         {'count': 3,
+                          'sample': {u"01/02/1999": 2, u"sometime": 1}})
+
+    def test_unparsed_sample_is_bounded(self):
+        size = DTFixer.DATE_SAMPLE_SIZE
+        for i in range(size * 3):
+            self.fix(u"circa {0}".format(i))
+        self.fix(u"circa 0")
+        self.fix(u"x" * (DTFixer.DATE_SAMPLE_LENGTH * 2))
+
+        unparsed = self.fixer.unparsed_dates
+        self.assertEqual(unparsed['count'], size * 3 + 2)
+        self.assertEqual(len(unparsed['sample']), size)
+        self.assertEqual(unparsed['sample'][u"circa 0"], 2)
+
+    def test_memo_is_bounded(self):
+        size = DTFixer.DATE_CACHE_SIZE
+        for i in range(size + 10):
+            day = date(1900, 1, 1) + timedelta(days=i)
+            self.assertEqual(self.fix(day.strftime(u"%Y/%m/%d")),
+                             day.isoformat())
+        self.assertTrue(len(self.fixer._dates) <= size)
+        # what was forgotten still parses
+        self.assertEqual(self.fix(u"1900/01/01"), u"1900-01-01")
+
+    def test_merged_sample_is_bounded(self):
+        # as the reports from worker processes are merged
+        other = DTFixer()
+        for i in range(DTFixer.DATE_SAMPLE_SIZE):
+            self.fix(u"early {0}".format(i))
+            other.fix_datatype('date', u"late {0}".format(i))
+
+        self.fixer.add_unparsed_dates(other.unparsed_dates)
+        unparsed = self.fixer.unparsed_dates
+        self.assertEqual(unparsed['count'], DTFixer.DATE_SAMPLE_SIZE * 2)
+        self.assertEqual(sorted(unparsed['sample']),
+                         sorted(u"early {0}".format(i) for i in
+                                range(DTFixer.DATE_SAMPLE_SIZE)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Checks that find_v3_resource, started from any byte of an export, lands on
+the next resource rather than on an entity nested in one, including
+entities that carry their resource model's entitytypeid.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import find_v3_resource, iter_v3_resources
+
+MODELS = {u"HERITAGE_RESOURCE.E18": u"Historic Resource",
+          u"ACTOR.E39": u"Actor"}
+
+
+def entity(rand, entitytypeid, depth):
+    children = [entity(rand, rand.choice([u"NAME.E41", u"NOTE.E62",
+                                          u"ACTOR.E39"]), depth - 1)
+                for i in range(rand.randint(0, 3) if depth else 0)]
+    return {u"entitytypeid": entitytypeid,
+            u"entityid": u"{0:032x}".format(rand.getrandbits(128)),
+            u"businesstablename": u"strings" if not children else u"",
+            u"value": rand.choice([u"", u"{not json}", u"café ]},{",
+                                  u'"quoted" {"a": 1}']),
+            u"child_entities": children}
+
+
+class FindV3ResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='find_v3_resource_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_export(self, indent):
+        rand = random.Random(indent or 0)
+        path = os.path.join(self.directory, 'export.json')
+        with open(path, 'w') as outfile:
+            json.dump({u"resources": [
+                entity(rand, rand.choice(sorted(MODELS)), 2)
+                for i in range(6)]}, outfile, indent=indent)
+        return path
+
+    def check_every_offset(self, path):
+        starts = [start for r, start, end in iter_v3_resources(path,
+                                                               spans=True)]
+        for offset in range(os.path.getsize(path)):
+            expected = min([start for start in starts if start >= offset] or
+                           [None])
+            self.assertEqual(find_v3_resource(path, offset, MODELS,
+                                              window=64), expected)
+
+    def test_compact(self):
+        self.check_every_offset(self.write_export(None))
+
+    def test_indented(self):
+        self.check_every_offset(self.write_export(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# coding: utf-8
+"""
+Checks ResourceModelMigrator.get_v4_rows against the row condensation it
+replaced, which is kept here as the oracle, over random node lists.
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import ResourceModelMigrator
+
+PRIMARY_NAME_TYPE = "a4c88313-52c5-4b6a-9579-3fc5aad17335"
+
+
+def old_get_v4_rows(v4_nodes, resource_id):
+    "get_v4_rows as it was before it condensed rows in a single pass"
+    resource = list(v4_nodes)
+    outrows = []
+    names, name_types = [], []
+
+    while len(resource) > 0:
+        newrow = {u"ResourceID": resource_id}
+        added = []
+
+        for index, node in enumerate(resource):
+
+            node_name, value = node[0], node[1]
+
+            if node_name == "Name" or node_name == "Name Type":
+                if node_name == "Name":
+                    names.append(node)
+                else:
+                    name_types.append(node)
+                added.append(index)
+                continue
+
+            if not node_name in newrow.keys():
+                added.append(index)
+                newrow[node_name] = value
+
+        outrows.append(newrow)
+
+        resource = [v for i, v in enumerate(resource) if not i in added]
+
+    names_concat = zip(names, name_types)
+    for pair in names_concat:
+        newrow = {
+            u"ResourceID": resource_id,
+            pair[0][0]: pair[0][1],
+            pair[1][0]: pair[1][1],
+        }
+        if pair[1][1] == PRIMARY_NAME_TYPE:
+            outrows.insert(0, newrow)
+        else:
+            outrows.append(newrow)
+
+    return outrows
+
+
+class Migrator(ResourceModelMigrator):
+    "just enough of a migrator to condense rows"
+
+    def __init__(self):
+        pass
+
+
+class GetV4RowsTest(unittest.TestCase):
+
+    NODE_NAMES = [u'Name', u'Name Type', u'Description', u'Keyword',
+                  u'Date', u'Café']
+    NAME_TYPES = [PRIMARY_NAME_TYPE, u'1b2f3a44-alternate', u'']
+
+    def setUp(self):
+        self.migrator = Migrator()
+        self.random = random.Random(0)
+
+    def random_nodes(self, names):
+        rand = self.random
+        nodes = []
+        for i in range(rand.randint(0, 25)):
+            name = rand.choice(names)
+            if name == u'Name Type':
+                value = rand.choice(self.NAME_TYPES)
+            else:
+                value = rand.choice([u'', u'a', u'b, c', u'é'])
+            nodes.append((name, value))
+        return nodes
+
+    def check(self, nodes, resource_id=u'res-1'):
+        self.assertEqual(self.migrator.get_v4_rows(nodes, resource_id),
+                         old_get_v4_rows(nodes, resource_id))
+
+    def test_empty_resource(self):
+        self.check([])
+        self.assertEqual(self.migrator.get_v4_rows([], u'res-1'), [])
+
+    def test_names_only(self):
+        self.check([(u'Name', u'Mill'), (u'Name Type', PRIMARY_NAME_TYPE)])
+        self.check([(u'Name', u'Mill'), (u'Name', u'Old Mill'),
+                    (u'Name Type', u'other'),
+                    (u'Name Type', PRIMARY_NAME_TYPE)])
+        self.check([(u'Name', u'Mill')])
+
+    def test_random_resources(self):
+        for i in range(2000):
+            self.check(self.random_nodes(self.NODE_NAMES), u'res-%d' % i)
+
+    def test_random_names_only_resources(self):
+        for i in range(500):
+            self.check(self.random_nodes([u'Name', u'Name Type']))
+
+
+if __name__ == '__main__':
+    unittest.main()
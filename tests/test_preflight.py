@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+Checks that preflight resolves the v3 node names it has to guess the way
+the migration will, and reports as errors the ones that would come out as
+nodes the migrator can't convert.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import Migration
+
+NODES = [
+    (u"Name", u"string"),
+    (u"Place Description", u"string"),
+    (u"Location", u"semantic"),
+]
+
+GRAPHDIFF = {
+    u"NAME.E41": u"Name",
+    u"DESCRIPTION.E62": u"Place Descriptions",
+}
+
+
+def entity(entitytypeid, value=u"", children=()):
+    return {u"entitytypeid": entitytypeid,
+            u"entityid": u"",
+            u"businesstablename": u"strings" if not children else u"",
+            u"value": value,
+            u"child_entities": list(children)}
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='preflight_test')
+        path = self.directory + os.sep
+
+        with ZipFile(path + 'Place.zip', 'w') as mzip:
+            mzip.writestr('Place.mapping', json.dumps({
+                'resource_model_name': 'Place',
+                'nodes': [{'arches_node_name': name, 'data_type': datatype}
+                          for name, datatype in NODES]}))
+            mzip.writestr('Place_concepts.json', json.dumps({}))
+
+        with open(path + 'place.json', 'w') as outfile:
+            json.dump(GRAPHDIFF, outfile)
+
+        with open(path + 'config.json', 'w') as outfile:
+            json.dump({'namediffs': {u"PLACE.E53": u"Place"},
+                       'graphdiffs': {u"PLACE.E53": u"place.json"},
+                       'graphdiff_path': path}, outfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def preflight(self, *children):
+        path = os.path.join(self.directory, 'export.json')
+        with open(path, 'w') as outfile:
+            json.dump({u"resources": [
+                entity(u"PLACE.E53", children=children)]}, outfile)
+
+        migration = Migration(path, self.directory, self.directory,
+                              ["<all>"], config=os.path.join(self.directory,
+                                                             'config.json'))
+        return migration.preflight()
+
+    def test_fuzzy_matched_graphdiff_entry(self):
+        problems = self.preflight(entity(u"NAME.E41", u"Stone Bridge"),
+                                  entity(u"DESCRIPTION.E62", u"old"))
+        self.assertEqual([severity for severity, message in problems],
+                         ['warning'])
+        self.assertIn(u"fuzzy matched to Place Description", problems[0][1])
+
+    def test_guess_with_no_fixer_is_an_error(self):
+        problems = self.preflight(entity(u"NAME.E41", u"Stone Bridge"),
+                                  entity(u"LOCATION.E53", u"somewhere"))
+        self.assertEqual([severity for severity, message in problems],
+                         ['warning', 'error'])
+        self.assertIn(u"LOCATION.E53 (1 nodes)", problems[1][1])
+        self.assertIn(u"guessed: Location", problems[1][1])
+        self.assertIn(u"semantic", problems[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
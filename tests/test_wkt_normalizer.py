@@ -0,0 +1,155 @@
+# coding: utf-8
+"""
+Checks WKTNormalizer against hand-worked geometries: rings closed and
+wound the right way round, repeated vertices dropped, coordinates rounded,
+and anything it can't make sense of passed through and counted.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from graph_migrator import WKTNormalizer
+
+SQUARE = u"POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))"
+
+
+class WKTNormalizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wkt = WKTNormalizer()
+
+    def assertNormalized(self, wkt, expected, precision=None):
+        normalizer = WKTNormalizer(precision) if precision is not None \
+            else self.wkt
+        self.assertEqual(normalizer.normalize(wkt), expected)
+        # both paths, the cached one too
+        self.assertEqual(normalizer.normalize(wkt), expected)
+
+    def test_valid_polygon_passes_through(self):
+        self.assertNormalized(SQUARE, SQUARE)
+        self.assertNormalized(u"POLYGON((0 0,1 0,1 1,0 1,0 0))",
+                              u"POLYGON((0 0,1 0,1 1,0 1,0 0))")
+
+    def test_unclosed_ring(self):
+        self.assertNormalized(u"POLYGON ((0 0, 1 0, 1 1, 0 1))", SQUARE)
+        self.assertNormalized(u"polygon((0 0,1 0,1 1,0 1))", SQUARE)
+
+    def test_clockwise_exterior(self):
+        self.assertNormalized(u"POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0))",
+                              u"POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))")
+
+    def test_repeated_vertices(self):
+        self.assertNormalized(u"POLYGON ((0 0, 1 0, 1 0, 1 1, 0 1, 0 0))",
+                              SQUARE)
+        self.assertNormalized(u"LINESTRING (0 0, 1 1, 1 1, 2 0)",
+                              u"LINESTRING (0 0, 1 1, 2 0)")
+
+    def test_holes(self):
+        # holes run clockwise, and are closed like the exterior
+        self.assertNormalized(
+            u"POLYGON ((0 0, 10 0, 10 10, 0 10), (2 2, 4 2, 4 4, 2 4))",
+            u"POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), "
+            u"(2 2, 2 4, 4 4, 4 2, 2 2))")
+        hole = u"POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), " \
+            u"(2 2, 2 4, 4 4, 4 2, 2 2))"
+        self.assertNormalized(hole, hole)
+
+    def test_third_dimension(self):
+        self.assertNormalized(u"POLYGON Z ((0 0 1, 1 0 1, 1 1 1, 0 1 1))",
+                              u"POLYGON Z ((0 0 1, 1 0 1, 1 1 1, 0 1 1, "
+                              u"0 0 1))")
+
+    def test_multi_geometries(self):
+        self.assertNormalized(
+            u"MULTIPOLYGON (((0 0, 1 0, 1 1, 0 1)), "
+            u"((5 5, 5 6, 6 6, 6 5, 5 5)))",
+            u"MULTIPOLYGON (((0 0, 1 0, 1 1, 0 1, 0 0)), "
+            u"((5 5, 6 5, 6 6, 5 6, 5 5)))")
+        self.assertNormalized(u"MULTILINESTRING ((0 0, 1 1, 1 1), (2 2, 3 3))",
+                              u"MULTILINESTRING ((0 0, 1 1), (2 2, 3 3))")
+        for points in [u"MULTIPOINT (1 2, 3 4)",
+                       u"MULTIPOINT ((1 2), (3 4))"]:
+            self.assertNormalized(points, points)
+        self.assertNormalized(
+            u"GEOMETRYCOLLECTION (POINT (1 2), "
+            u"POLYGON ((0 0, 1 0, 1 1, 0 1)))",
+            u"GEOMETRYCOLLECTION (POINT (1 2), "
+            u"POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0)))")
+
+    def test_empty(self):
+        for wkt in [u"POINT EMPTY", u"POLYGON EMPTY", u"MULTIPOLYGON EMPTY",
+                    u"GEOMETRYCOLLECTION EMPTY"]:
+            self.assertNormalized(wkt, wkt)
+        self.assertNormalized(
+            u"GEOMETRYCOLLECTION (POINT EMPTY, LINESTRING (0 0, 0 0, 1 1))",
+            u"GEOMETRYCOLLECTION (POINT EMPTY, LINESTRING (0 0, 1 1))")
+        self.assertEqual(self.wkt.invalid['count'], 0)
+
+    def test_precision(self):
+        self.assertNormalized(u"POINT (1.23456 -7.891)", u"POINT (1.23 -7.89)",
+                              precision=2)
+        self.assertNormalized(u"POINT (1.004 -0.001)", u"POINT (1 0)",
+                              precision=2)
+        # rounding can make vertices repeat, which are then dropped
+        self.assertNormalized(
+            u"POLYGON ((0 0, 0.001 0, 1 0, 1 1, 0 1, 0 0))", SQUARE,
+            precision=2)
+        self.assertNormalized(u"LINESTRING (0.5 0.5, 1.25 1.75)",
+                              u"LINESTRING (0.5 0.5, 1.25 1.75)",
+                              precision=2)
+
+    def test_malformed_passes_through(self):
+        malformed = [
+            u"not wkt",
+            u"CIRCLE (1 2)",
+            u"POINT (1)",
+            u"POINT (a b)",
+            u"POINT (1 2) junk",
+            u"POLYGON ((0 0, 1 0",
+            u"POLYGON ((0 0, 1 0, 1 1, 0 1)) x",
+            u"POLYGON ((0 0, 1 0, 0 0))",
+            u"LINESTRING (0 0, 0 0)",
+            u"MULTIPOLYGON ()",
+            u"POINT (1 2; 3 4)",
+        ]
+        for wkt in malformed:
+            self.assertEqual(self.wkt.normalize(wkt), wkt)
+
+        self.assertEqual(self.wkt.invalid,
+                         {'count': len(malformed),
+                          'sample': dict((wkt, 1) for wkt in malformed)})
+
+        # the cached answer is counted as well
+        self.wkt.normalize(u"not wkt")
+        self.assertEqual(self.wkt.invalid['count'], len(malformed) + 1)
+        self.assertEqual(self.wkt.invalid['sample'][u"not wkt"], 2)
+
+    def test_invalid_record_is_bounded(self):
+        size = WKTNormalizer.SAMPLE_SIZE
+        for i in range(size * 3):
+            self.wkt.normalize(u"POINT ({0})".format(i))
+        long_wkt = u"POINT (" + u"1 " * WKTNormalizer.SAMPLE_LENGTH + u")"
+
+        other = WKTNormalizer()
+        other.normalize(long_wkt)
+        other.normalize(u"POINT (0)")
+        self.assertEqual(other.invalid['sample'],
+                         {long_wkt[:WKTNormalizer.SAMPLE_LENGTH]: 1,
+                          u"POINT (0)": 1})
+
+        # as a worker's record is merged into the parent's
+        self.wkt.add_invalid(other.invalid)
+        invalid = self.wkt.invalid
+        self.assertEqual(invalid['count'], size * 3 + 2)
+        self.assertEqual(len(invalid['sample']), size)
+        self.assertEqual(invalid['sample'][u"POINT (0)"], 2)
+        self.assertNotIn(long_wkt[:WKTNormalizer.SAMPLE_LENGTH],
+                         invalid['sample'])
+
+
+if __name__ == '__main__':
+    unittest.main()